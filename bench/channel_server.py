@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""
+Stand-in channel server for benchmarks.
+
+Serves synthetic Atom cache channels at /channel/<n>, each with an archive
+of older documents at /channel/<n>/archive/<number>, linked with
+prev-archive and numbered with cc:archive_num. New stale events appear at
+a steady rate; each document holds the given number of entries.
+
+Archive documents don't change once they're full, so they're served with
+strong ETags and answer conditional requests with 304. With --gzip,
+documents are compressed for clients that accept it.
+
+Usage: channel_server.py [options]; see --help.
+"""
+
+from __future__ import print_function
+
+import io
+import sys
+import gzip
+import time
+import optparse
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+
+FEED = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"
+      xmlns:cc="http://purl.org/syndication/cache-channel">
+<title>channel %(channel)s</title>
+<id>%(self)s</id>
+<updated>%(updated)s</updated>
+<cc:precision>%(precision)s</cc:precision>
+<cc:lifetime>%(lifetime)s</cc:lifetime>
+<cc:archive_num>%(archive_num)s</cc:archive_num>
+%(links)s%(entries)s</feed>
+"""
+ENTRY = """<entry>
+<title>stale</title>
+<id>urn:event:%(channel)s:%(event)s</id>
+<link href="%(uri)s"/>
+<updated>%(updated)s</updated>
+<cc:stale/>
+</entry>
+"""
+
+def event_uri(host, channel, event, pages):
+    return "http://%s/c%s/page/%i" % (host, channel, event % pages)
+
+def rfc3339(when):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(when))
+
+class Channels:
+    """
+    Event e of every channel happens at start + e / rate; channel
+    documents hold entries events each, so that archive document a holds
+    events [a * entries, (a + 1) * entries) and the current document holds
+    the newest ones. Only the newest archives (those within depth of the
+    current document) are linked.
+    """
+    def __init__(self, host, entries=100, depth=5, rate=1.0, pages=10000,
+                 precision=60, lifetime=3600, start=None):
+        self.host = host
+        self.entries = entries
+        self.depth = depth
+        self.rate = rate
+        self.pages = pages
+        self.precision = precision
+        self.lifetime = lifetime
+        self.start = start or time.time() - (depth + 1) * entries / rate
+
+    def newest_event(self):
+        return int((time.time() - self.start) * self.rate)
+
+    def document(self, channel, archive=None):
+        newest = self.newest_event()
+        current = newest // self.entries
+        if archive is None:
+            archive_num = current
+            first, last = max(0, newest - self.entries + 1), newest
+            self_uri = "http://%s/channel/%s" % (self.host, channel)
+        elif archive >= current or archive < current - self.depth - 1:
+            return None
+        else:
+            archive_num = archive
+            first = archive * self.entries
+            last = first + self.entries - 1
+            self_uri = "http://%s/channel/%s/archive/%i" % (
+                self.host, channel, archive
+            )
+        links = ['<link rel="self" href="%s"/>\n' % self_uri]
+        if archive_num > 0 and archive_num > current - self.depth:
+            links.append(
+                '<link rel="prev-archive" href="/channel/%s/archive/%i"/>\n' %
+                (channel, archive_num - 1)
+            )
+        entries = [ENTRY % {
+            'channel': channel,
+            'event': event,
+            'uri': event_uri(self.host, channel, event, self.pages),
+            'updated': rfc3339(self.start + event / self.rate),
+        } for event in range(last, first - 1, -1)]
+        return FEED % {
+            'channel': channel,
+            'self': self_uri,
+            'updated': rfc3339(self.start + last / self.rate),
+            'precision': self.precision,
+            'lifetime': self.lifetime,
+            'archive_num': archive_num,
+            'links': "".join(links),
+            'entries': "".join(entries),
+        }
+
+class ChannelHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        archive = None
+        try:
+            if parts[0] != "channel" or len(parts) not in [2, 4]:
+                raise ValueError
+            channel = parts[1]
+            if len(parts) == 4:
+                if parts[2] != "archive":
+                    raise ValueError
+                archive = int(parts[3])
+        except (IndexError, ValueError):
+            return self.respond(404, b"")
+        doc = self.server.channels.document(channel, archive)
+        if doc is None:
+            return self.respond(404, b"")
+        headers = {"Content-Type": "application/atom+xml"}
+        if archive is not None:
+            etag = '"%s-%i"' % (channel, archive)
+            headers["ETag"] = etag
+            headers["Cache-Control"] = "max-age=31536000"
+            if self.headers.get("If-None-Match") == etag:
+                return self.respond(304, b"", headers)
+        body = doc.encode("utf-8")
+        if self.server.gzip and \
+        "gzip" in self.headers.get("Accept-Encoding", ""):
+            buf = io.BytesIO()
+            gz = gzip.GzipFile(fileobj=buf, mode="wb")
+            gz.write(body)
+            gz.close()
+            body = buf.getvalue()
+            headers["Content-Encoding"] = "gzip"
+            headers["Vary"] = "Accept-Encoding"
+        self.respond(200, body, headers)
+
+    def respond(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class ChannelServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def options(parser=None):
+    parser = parser or optparse.OptionParser()
+    parser.add_option("--port", type="int", default=8765)
+    parser.add_option("--entries", type="int", default=100,
+        help="entries in each channel document")
+    parser.add_option("--depth", type="int", default=5,
+        help="archive documents linked from the current one")
+    parser.add_option("--rate", type="float", default=1.0,
+        help="new stale events per second, per channel")
+    parser.add_option("--pages", type="int", default=10000,
+        help="distinct URIs per channel that events are for")
+    parser.add_option("--precision", type="int", default=60)
+    parser.add_option("--lifetime", type="int", default=3600)
+    parser.add_option("--gzip", action="store_true",
+        help="compress documents for clients that accept gzip")
+    return parser
+
+def serve(opts):
+    host = "127.0.0.1:%i" % opts.port
+    server = ChannelServer(("127.0.0.1", opts.port), ChannelHandler)
+    server.channels = Channels(host, opts.entries, opts.depth, opts.rate,
+        opts.pages, opts.precision, opts.lifetime
+    )
+    server.gzip = opts.gzip
+    server.serve_forever()
+
+if __name__ == "__main__":
+    opts, args = options().parse_args()
+    serve(opts)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+Event store benchmark.
+
+Compares the memory use and lookup speed of the channel event stores
+(see event_store in the sample configuration). Each store is measured
+in its own process, so that memory figures aren't polluted by the others.
+
+Usage: event_store.py [number_of_events] [number_of_lookups]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+import manager
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+
+def rss_kb():
+    for line in open("/proc/self/status"):
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def make_uri(i):
+    return "http://www.example.com/articles/%i/index.html?rev=%i" % (i, i * 7)
+
+def measure(store_name, num_events, num_lookups):
+    base_rss = rss_kb()
+    start = time.time()
+    events = manager.EVENT_STORES[store_name]()
+    now = time.time()
+    for i in xrange(num_events):
+        events[make_uri(i)] = now - random.random() * 604800
+    load_time = time.time() - start
+    store_rss = rss_kb() - base_rss
+
+    probes = [make_uri(random.randrange(num_events))
+              for i in xrange(num_lookups // 2)] + \
+        ["http://www.example.com/missing/%i" % i
+         for i in xrange(num_lookups // 2)]
+    random.shuffle(probes)
+    start = time.time()
+    for uri in probes:
+        if uri in events and events[uri] > 0:
+            pass
+    lookup_time = time.time() - start
+    print("%-8s %10i events %10i KB %8.2f s load %8.2f us/lookup" % (
+        store_name, len(events), store_rss, load_time,
+        lookup_time / len(probes) * 1000000
+    ))
+
+def main():
+    num_events = int((sys.argv[1:2] or [1000000])[0])
+    num_lookups = int((sys.argv[2:3] or [200000])[0])
+    if os.environ.get("EVENT_STORE"):
+        measure(os.environ["EVENT_STORE"], num_events, num_lookups)
+        return
+    for store_name in sorted(manager.EVENT_STORES.keys()):
+        env = dict(os.environ)
+        env["EVENT_STORE"] = store_name
+        subprocess.call([sys.executable] + sys.argv, env=env)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+Lookup microbenchmark.
+
+Times SquidHandler.process() on its own, without I/O, the reactor or the
+channel server, for lookups that get each kind of answer: FRESH, stale
+because of an event for the request-URI, and stale because of the
+response's age. Channels are set up as if they had just been checked.
+
+Usage: lookup.py [number_of_lookups] [repeats]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+import manager
+from twisted.internet import reactor
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+
+NUM_CHANNELS = 10
+NUM_PAGES = 10000
+
+def channel_uri(channel):
+    return "http://channels.example.com/channel/%i" % channel
+
+def page_uri(channel, page):
+    return "http://www%i.example.com/articles/%i" % (channel, page)
+
+def make_manager():
+    config = manager.ConfigParser(manager.CONFIG_DEFAULTS, allow_no_value=True)
+    config.add_section("main")
+    mgr = manager.ChannelManager(reactor, config)
+    now = time.time()
+    for c in xrange(NUM_CHANNELS):
+        events = manager.EVENT_STORES[config.get("main", "event_store")]()
+        for page in xrange(0, NUM_PAGES, 10):
+            events[page_uri(c, page)] = now - 30
+        mgr.add_channel(channel_uri(c))
+        channel = mgr.channels[channel_uri(c)]
+        channel.update({
+            'precision': 60,
+            'lifetime': 604800,
+            'events': events,
+            'last_check_elapsed': 0.1,
+        })
+        mgr._check_done(channel)
+    return mgr
+
+def make_lines(kind, count):
+    """
+    Lookup lines whose answer is FRESH ("fresh"), STALE because of an event
+    ("event") or STALE because they're older than channel-maxage ("maxage").
+    """
+    rnd = random.Random(1)
+    lines = []
+    for i in xrange(count):
+        c = rnd.randrange(NUM_CHANNELS)
+        page = rnd.randrange(NUM_PAGES // 10) * 10
+        if kind != "event":
+            page += 1
+        age = kind == "maxage" and 7200 or 60
+        cc = 'max-age=60, channel="%s", channel-maxage=3600' % channel_uri(c)
+        lines.append("%i %s %i %s -" % (
+            i, page_uri(c, page), age, quote(cc, safe="")
+        ))
+    return lines
+
+def measure(handler, kind, lines, repeats):
+    answers = {}
+    for line in lines:  # warm the header cache
+        answers[handler.process(line).split()[1]] = True
+    best = None
+    for r in xrange(repeats):
+        start = time.time()
+        for line in lines:
+            handler.process(line)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print("%-7s %-6s %8.2f us/lookup" % (
+        kind, ",".join(sorted(answers)), best / len(lines) * 1000000
+    ))
+
+def main():
+    num_lookups = int((sys.argv[1:2] or [100000])[0])
+    repeats = int((sys.argv[2:3] or [5])[0])
+    handler = manager.SquidHandler(make_manager())
+    for kind in ["fresh", "event", "maxage"]:
+        measure(handler, kind, make_lines(kind, num_lookups), repeats)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+
+"""
+Replay benchmark for the Squid helper.
+
+Starts channel_server.py, then replays external_refresh_check lines at
+the channel manager, keeping a given number of lookups outstanding at once
+(Squid's concurrency). The manager runs either in this process, driving
+ChannelManager and SquidHandlerProtocol on the Twisted reactor (--mode
+direct), or as Squid would run it, over stdin and stdout (--mode stdio).
+
+Once every channel has been checked, it measures the CPU that polling uses
+while no lookups arrive, and then replays the lookups. It reports
+lookups/sec, p50/p99 latency (from sending a line to reading its answer),
+RSS and poll CPU, along with the answers given.
+
+Usage: replay.py [options]; see --help. With --generate, lines are
+written to stdout instead of being replayed; --lines replays them from a
+file.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import shutil
+import socket
+import optparse
+import resource
+import tempfile
+import subprocess
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+MANAGER = os.path.join(BENCH_DIR, "..", "src", "manager.py")
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "src"))
+import manager
+import channel_server
+from twisted.internet import reactor, protocol
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+
+def generate(opts):
+    """
+    Yield lookup lines for pages of the stand-in channels; group_pct of
+    them also say that a group URI invalidates them.
+    """
+    host = "127.0.0.1:%i" % opts.port
+    rnd = random.Random(opts.seed)
+    for i in xrange(opts.lookups):
+        channel = rnd.randrange(opts.channels)
+        uri = channel_server.event_uri(
+            host, channel, rnd.randrange(opts.pages), opts.pages
+        )
+        cc = 'max-age=60, channel="http://%s/channel/%i", channel-maxage' % (
+            host, channel
+        )
+        link = "-"
+        if rnd.random() * 100 < opts.group_pct:
+            link = quote('<http://%s/c%i/>; rev="invalidates"' % (
+                host, channel
+            ), safe="")
+        yield "%i %s %i %s %s" % (
+            i, uri, rnd.randrange(opts.max_age), quote(cc, safe=""), link
+        )
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def rss_kb(pid):
+    for line in open("/proc/%i/status" % pid):
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1])
+    return 0
+
+def cpu_seconds(pid):
+    if pid == os.getpid():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+    fields = open("/proc/%i/stat" % pid).read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / \
+        float(os.sysconf("SC_CLK_TCK"))
+
+
+class Driver:
+    """
+    Sends lines to the helper through send(), and is told what it writes
+    back through received(); keeps up to concurrency lookups outstanding.
+    """
+    def __init__(self, opts, lines, send, pid):
+        self.opts = opts
+        self.lines = lines
+        self.send = send
+        self.pid = pid
+        self.buffer = b""
+        self.sent = {}  # req_id: time sent
+        self.latencies = []
+        self.verdicts = {}
+        self.probing = None  # {req_id: channel}, while warming up
+        self.warm = set()
+        self.results = None
+
+    def start(self):
+        self.started = time.time()
+        self.probe()
+
+    def probe(self):
+        """
+        Ask about a page of each channel not yet checked, until all are.
+        """
+        if time.time() - self.started > self.opts.warmup:
+            sys.stderr.write("warning: not all channels checked\n")
+            return self.measure_polling()
+        host = "127.0.0.1:%i" % self.opts.port
+        self.probing = {}
+        out = []
+        for channel in range(self.opts.channels):
+            if channel in self.warm:
+                continue
+            req_id = "p%i" % channel
+            self.probing[req_id] = channel
+            out.append("%s http://%s/c%i/ 0 %s -\n" % (req_id, host, channel,
+                quote('channel="http://%s/channel/%i", channel-maxage' % (
+                    host, channel
+                ), safe="")
+            ))
+        if not out:
+            self.probing = None
+            return self.measure_polling()
+        self.send("".join(out).encode("ascii"))
+        reactor.callLater(0.25, self.probe)
+
+    def measure_polling(self):
+        self.poll_cpu = cpu_seconds(self.pid)
+        self.poll_checks = self.checks()
+        reactor.callLater(self.opts.poll_seconds, self.replay)
+
+    def replay(self):
+        self.poll_cpu = (cpu_seconds(self.pid) - self.poll_cpu) / \
+            self.opts.poll_seconds
+        self.poll_checks = self.checks() - self.poll_checks
+        self.replay_start = time.time()
+        self.fill()
+
+    def checks(self):
+        return None
+
+    def fill(self):
+        out = []
+        now = time.time()
+        while len(self.sent) + len(out) < self.opts.concurrency:
+            try:
+                line = next(self.lines)
+            except StopIteration:
+                break
+            self.sent[line.split(None, 1)[0]] = now
+            out.append(line + "\n")
+        if out:
+            self.send("".join(out).encode("ascii"))
+        elif not self.sent:
+            self.finish()
+
+    def received(self, data):
+        now = time.time()
+        self.buffer += data
+        lines = self.buffer.split(b"\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            line = line.decode("ascii", "replace")
+            req_id = line.split(None, 1)[0]
+            verdict = line.rsplit("log=", 1)[-1]
+            if self.probing is not None:
+                if req_id in self.probing and verdict not in [
+                    "channel_not_monitored", "channel_startup"
+                ]:
+                    self.warm.add(self.probing[req_id])
+                continue
+            sent = self.sent.pop(req_id, None)
+            if sent is None:
+                continue
+            self.latencies.append(now - sent)
+            if verdict.startswith("extended_"):
+                verdict = "extended"
+            self.verdicts[verdict] = self.verdicts.get(verdict, 0) + 1
+        if self.probing is None:
+            reactor.callLater(0, self.fill)
+
+    def finish(self):
+        elapsed = time.time() - self.replay_start
+        self.latencies.sort()
+        self.results = {
+            'lookups': len(self.latencies),
+            'rate': len(self.latencies) / elapsed,
+            'p50': percentile(self.latencies, 50) * 1000,
+            'p99': percentile(self.latencies, 99) * 1000,
+            'rss': rss_kb(self.pid),
+            'poll_cpu': self.poll_cpu * 100,
+            'poll_checks': self.poll_checks,
+            'verdicts': self.verdicts,
+        }
+        self.stop()
+
+    def stop(self):
+        reactor.stop()
+
+
+class _Output:
+    disconnecting = False
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def write(self, data):
+        self.driver.received(data)
+
+class DirectDriver(Driver):
+    """
+    Runs ChannelManager and SquidHandlerProtocol in this process.
+    """
+    def __init__(self, opts, lines, config):
+        self.manager = manager.ChannelManager(reactor, config)
+        self.handler = manager.SquidHandlerProtocol(self.manager)
+        self.handler.transport = _Output(self)
+        Driver.__init__(self, opts, lines, self.handler.dataReceived,
+            os.getpid()
+        )
+
+    def checks(self):
+        return self.manager.metrics.check_seconds.count
+
+    def run(self):
+        reactor.callWhenRunning(self.start)
+        self.manager.start()
+
+    def stop(self):
+        self.manager.shutdown()
+
+
+class _HelperProtocol(protocol.ProcessProtocol):
+    def __init__(self, driver):
+        self.driver = driver
+
+    def outReceived(self, data):
+        self.driver.received(data)
+
+    def processEnded(self, reason):
+        if self.driver.results is None:
+            sys.stderr.write("helper exited early: %s\n" % reason.value)
+            reactor.stop()
+
+class StdioDriver(Driver):
+    """
+    Runs manager.py as Squid would, talking to it over stdin and stdout.
+    """
+    def __init__(self, opts, lines, configfile, metrics_socket):
+        self.configfile = configfile
+        self.metrics_socket = metrics_socket
+        self.process = reactor.spawnProcess(
+            _HelperProtocol(self), sys.executable,
+            [sys.executable, MANAGER, configfile], env=os.environ,
+            childFDs={0: "w", 1: "r", 2: 2}
+        )
+        Driver.__init__(self, opts, lines, self.process.write,
+            self.process.pid
+        )
+
+    def checks(self):
+        try:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.connect(self.metrics_socket)
+            s.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+            data = b""
+            while True:
+                chunk = s.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            s.close()
+        except socket.error:
+            return None
+        for line in data.decode("ascii").split("\n"):
+            if line.startswith("squid_channels_check_seconds_count "):
+                return int(line.split()[1])
+        return None
+
+    def run(self):
+        reactor.callWhenRunning(self.start)
+        reactor.run()
+
+    def stop(self):
+        self.process.closeStdin()
+        reactor.callLater(self.opts.poll_seconds, reactor.stop)
+
+
+def write_config(opts, tmpdir):
+    settings = {
+        'dbfile': os.path.join(tmpdir, "db"),
+        'logfile': os.path.join(tmpdir, "log"),
+        'log_level': "WARNING",
+        'fetch_timeout': "10",
+        'metrics_address': os.path.join(tmpdir, "metrics.sock"),
+    }
+    for setting in opts.set:
+        name, value = setting.split("=", 1)
+        settings[name.strip()] = value.strip()
+    configfile = os.path.join(tmpdir, "channels.conf")
+    fh = open(configfile, "w")
+    fh.write("[main]\n")
+    for name, value in sorted(settings.items()):
+        fh.write("%s = %s\n" % (name, value))
+    fh.close()
+    config = manager.ConfigParser(manager.CONFIG_DEFAULTS, allow_no_value=True)
+    config.read(configfile)
+    return configfile, config, settings['metrics_address']
+
+def start_server(opts):
+    args = [sys.executable, os.path.join(BENCH_DIR, "channel_server.py")]
+    for name in ["port", "entries", "depth", "rate", "pages", "precision",
+                 "lifetime"]:
+        args.extend(["--%s" % name, str(getattr(opts, name))])
+    if opts.gzip:
+        args.append("--gzip")
+    server = subprocess.Popen(args)
+    for i in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", opts.port), 1).close()
+            return server
+        except socket.error:
+            time.sleep(0.1)
+    server.kill()
+    raise SystemExit("channel server didn't start")
+
+def main():
+    parser = channel_server.options(optparse.OptionParser())
+    parser.set_defaults(precision=10, lifetime=600, port=18765)
+    parser.add_option("--mode", choices=["direct", "stdio"], default="stdio")
+    parser.add_option("--channels", type="int", default=20)
+    parser.add_option("--lookups", type="int", default=50000)
+    parser.add_option("--concurrency", type="int", default=99)
+    parser.add_option("--max-age", type="int", default=60)
+    parser.add_option("--group-pct", type="float", default=10)
+    parser.add_option("--seed", type="int", default=1)
+    parser.add_option("--warmup", type="float", default=30,
+        help="most seconds to wait for channels to be checked")
+    parser.add_option("--poll-seconds", type="float", default=20,
+        help="seconds to measure polling CPU over")
+    parser.add_option("--lines", help="replay lines from this file")
+    parser.add_option("--generate", action="store_true")
+    parser.add_option("--set", action="append", default=[],
+        help="a manager configuration setting (name=value)")
+    opts, args = parser.parse_args()
+    if opts.generate:
+        for line in generate(opts):
+            print(line)
+        return
+    if opts.lines:
+        lines = (
+            line.rstrip("\n") for line in open(opts.lines) if line.strip()
+        )
+    else:
+        lines = generate(opts)
+    tmpdir = tempfile.mkdtemp(prefix="replay-")
+    server = start_server(opts)
+    try:
+        configfile, config, metrics_socket = write_config(opts, tmpdir)
+        if opts.mode == "direct":
+            manager.logging.getLogger().setLevel(manager.logging.WARNING)
+            driver = DirectDriver(opts, lines, config)
+        else:
+            driver = StdioDriver(opts, lines, configfile, metrics_socket)
+        driver.run()
+    finally:
+        server.kill()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    r = driver.results
+    if r is None:
+        raise SystemExit("no results")
+    print("%-6s %8s %10s %8s %8s %9s %9s %7s" % (
+        "mode", "lookups", "lookups/s", "p50 ms", "p99 ms", "RSS KB",
+        "poll CPU", "checks"
+    ))
+    print("%-6s %8i %10.0f %8.3f %8.3f %9i %8.2f%% %7s" % (
+        opts.mode, r['lookups'], r['rate'], r['p50'], r['p99'], r['rss'],
+        r['poll_cpu'], r['poll_checks']
+    ))
+    print("answers: %s" % ", ".join([
+        "%s %i" % item for item in sorted(r['verdicts'].items())
+    ]))
+
+if __name__ == "__main__":
+    main()
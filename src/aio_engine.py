@@ -0,0 +1,528 @@
+"""
+asyncio engine for the Cache Channel Manager.
+
+Runs the same ChannelManager (scheduler, GC and state) and SquidHandler
+verdicts as manager.py, on an asyncio event loop rather than the Twisted
+reactor. Select it with engine = asyncio; it needs Python 3.7+, and uses
+uvloop if it's installed.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import socket
+import ssl
+import stat
+import sys
+from collections import deque
+from urllib.parse import urljoin, urlsplit
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+import manager
+
+
+class LoopReactor:
+    """
+    The parts of the Twisted reactor that ChannelManager uses, on an
+    asyncio loop.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.starting = []  # coroutines to run when the loop starts
+        self.tasks = set()  # the loop only keeps weak references
+
+    def callLater(self, delay, f, *args):
+        return self.loop.call_later(max(delay, 0), f, *args)
+
+    def spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def run(self):
+        for coro in self.starting:
+            self.spawn(coro)
+        self.starting = []
+        self.loop.run_forever()
+
+    def stop(self):
+        self.loop.stop()
+
+
+class AsyncioResolver(manager.HostCache):
+    """
+    Looks up hosts with the loop's getaddrinfo(), which doesn't say how
+    long the answer is good for; it's kept for dns_ttl seconds.
+    """
+    def __init__(self, loop, config):
+        manager.HostCache.__init__(self, config)
+        self.loop = loop
+        self.tasks = set()
+
+    def _resolve(self, host, callback, errback):
+        task = self.loop.create_task(
+            self._getaddrinfo(host, callback, errback)
+        )
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _getaddrinfo(self, host, callback, errback):
+        try:
+            infos = await self.loop.getaddrinfo(
+                host, None, family=socket.AF_INET, type=socket.SOCK_STREAM
+            )
+        except (socket.gaierror, UnicodeError) as why:
+            errback(str(why))
+            return
+        addresses = list(set([info[4][0] for info in infos]))
+        if not addresses:
+            errback("no addresses")
+            return
+        callback(addresses, self.max_ttl)
+
+    def address(self, host):
+        """
+        Return a future for host's address; it raises socket.gaierror if
+        the host can't be found.
+        """
+        future = self.loop.create_future()
+        def found(address):
+            if not future.done():
+                future.set_result(address)
+        def not_found(msg):
+            if not future.done():
+                future.set_exception(socket.gaierror(msg))
+        self.lookup(host, found, not_found)
+        return future
+
+
+class HTTPError(Exception):
+    pass
+
+class AsyncioFetcher(manager.FetchQueue):
+    """
+    Fetches documents over persistent HTTP/1.1 connections, keyed by the
+    proxy (if configured) or the origin server, following redirects. Up to
+    max_host_connections idle connections are kept to each, for
+    idle_timeout seconds. Origin servers' addresses come from a shared
+    AsyncioResolver.
+    """
+    max_header_lines = 100
+    max_redirects = 20
+    redirect_codes = [301, 302, 303, 307, 308]
+
+    def __init__(self, loop, config):
+        manager.FetchQueue.__init__(self, config)
+        self.loop = loop
+        self.max_idle = config.getint("main", "max_host_connections")
+        self.idle_timeout = config.getint("main", "idle_timeout")
+        self.proxy = None
+        self.hosts = None
+        proxy = config.get("main", "http_proxy")
+        if proxy:
+            host, port = proxy.split(':')
+            self.proxy = ('http', host, int(port))
+        else:
+            self.hosts = AsyncioResolver(loop, config)
+        self.idle = {}  # (scheme, host, port): deque([(reader, writer)])
+        self.idle_timers = {}  # writer: TimerHandle
+        self.tasks = set()
+
+    def _request(self, url, headers, callback, errback):
+        task = self.loop.create_task(
+            self._fetch(url, headers, callback, errback)
+        )
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _fetch(self, url, headers, callback, errback):
+        try:
+            status, phrase, page, res_headers = await asyncio.wait_for(
+                self._get(url, headers), self.timeout
+            )
+        except asyncio.TimeoutError:
+            errback(None, '"Timeout"')
+            return
+        except socket.gaierror:
+            errback(None, '"DNS lookup error"')
+            return
+        except ConnectionRefusedError:
+            errback(None, '"Connection refused"')
+            return
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                HTTPError, ConnectionError):
+            errback(None, '"Response failed"')
+            return
+        except OSError:
+            errback(None, '"Connection error"')
+            return
+        except ValueError as why:
+            errback(None, '"Unknown error (%s)"' % why)
+            return
+        if status != 200:
+            errback(status, '"%s %s"' % (status, phrase))
+        else:
+            callback(page, res_headers)
+
+    async def _get(self, url, headers):
+        for redirects in range(self.max_redirects + 1):
+            result = await self._get_one(url, headers)
+            status, phrase, page, res_headers = result
+            location = res_headers.get('location', [None])[0]
+            if status not in self.redirect_codes or not location:
+                return result
+            url = urljoin(url, location)
+        raise HTTPError("too many redirects")
+
+    async def _get_one(self, url, headers):
+        parts = urlsplit(url)
+        if parts.scheme not in ['http', 'https'] or not parts.hostname:
+            raise ValueError("can't fetch %s" % url)
+        origin = (
+            parts.scheme, parts.hostname,
+            parts.port or {'http': 80, 'https': 443}[parts.scheme]
+        )
+        if self.proxy:
+            key, target = self.proxy, url
+        else:
+            key = origin
+            target = parts.path or "/"
+            if parts.query:
+                target = "%s?%s" % (target, parts.query)
+        lines = ["GET %s HTTP/1.1" % target, "Host: %s" % parts.netloc]
+        for name, value in headers.items():
+            lines.append("%s: %s" % (name, value))
+        request = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+        while True:
+            reader, writer, reused = await self._connect(key)
+            try:
+                writer.write(request)
+                result = await self._read_response(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                writer.close()
+                if reused:
+                    continue # the server closed an idle connection; retry
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            status, phrase, page, res_headers, keep_alive = result
+            if keep_alive:
+                self._release(key, reader, writer)
+            else:
+                writer.close()
+            return status, phrase, page, res_headers
+
+    async def _connect(self, key):
+        idle = self.idle.get(key, None)
+        while idle:
+            reader, writer = idle.pop()
+            self.idle_timers.pop(writer).cancel()
+            if not idle:
+                del self.idle[key]
+            if reader.at_eof() or writer.is_closing():
+                writer.close()
+                continue
+            return reader, writer, True
+        scheme, host, port = key
+        context = server_hostname = None
+        if scheme == 'https':
+            context = ssl.create_default_context()
+            server_hostname = host
+        if self.hosts is not None:
+            host = await self.hosts.address(host)
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=context, server_hostname=server_hostname
+        )
+        return reader, writer, False
+
+    def _release(self, key, reader, writer):
+        idle = self.idle.setdefault(key, deque())
+        if len(idle) >= self.max_idle:
+            writer.close()
+            return
+        idle.append((reader, writer))
+        self.idle_timers[writer] = self.loop.call_later(
+            self.idle_timeout, self._expire, key, reader, writer
+        )
+
+    def _expire(self, key, reader, writer):
+        idle = self.idle.get(key, None)
+        if idle is None or (reader, writer) not in idle:
+            return
+        idle.remove((reader, writer))
+        if not idle:
+            del self.idle[key]
+        del self.idle_timers[writer]
+        writer.close()
+
+    async def _read_response(self, reader):
+        while True:
+            status_line = await reader.readline()
+            if not status_line:
+                raise asyncio.IncompleteReadError(b"", None)
+            try:
+                version, status, phrase = (
+                    status_line.decode('latin-1').rstrip("\r\n").split(" ", 2)
+                    + [""]
+                )[:3]
+                status = int(status)
+            except ValueError:
+                raise HTTPError("bad status line %r" % status_line)
+            res_headers = await self._read_headers(reader)
+            if not 100 <= status < 200:
+                break
+        connection = ",".join(res_headers.get('connection', [])).lower()
+        keep_alive = version == "HTTP/1.1" and "close" not in connection
+        encoding = ",".join(res_headers.get('transfer-encoding', [])).lower()
+        if status in [204, 304]:
+            page = b""
+        elif "chunked" in encoding:
+            page = await self._read_chunked(reader)
+        elif 'content-length' in res_headers:
+            try:
+                length = int(res_headers['content-length'][0])
+            except ValueError:
+                raise HTTPError("bad content-length")
+            page = await reader.readexactly(length)
+        else:
+            page = await reader.read()
+            keep_alive = False
+        return status, phrase, page, res_headers, keep_alive
+
+    async def _read_headers(self, reader):
+        res_headers = {}
+        name = None
+        for i in range(self.max_header_lines):
+            line = (await reader.readline()).decode('latin-1')
+            if not line:
+                raise asyncio.IncompleteReadError(b"", None)
+            line = line.rstrip("\r\n")
+            if not line:
+                return res_headers
+            if line[0] in " \t" and name is not None:
+                res_headers[name][-1] += " " + line.strip()
+                continue
+            try:
+                name, value = line.split(":", 1)
+            except ValueError:
+                raise HTTPError("bad header line %r" % line)
+            name = name.strip().lower()
+            res_headers.setdefault(name, []).append(value.strip())
+        raise HTTPError("too many headers")
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        while True:
+            size_line = await reader.readline()
+            try:
+                size = int(size_line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise HTTPError("bad chunk size %r" % size_line)
+            if size == 0:
+                await self._read_headers(reader) # trailers
+                return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    def close(self):
+        for task in list(self.tasks):
+            task.cancel()
+        for idle in self.idle.values():
+            for reader, writer in idle:
+                writer.close()
+        for timer in self.idle_timers.values():
+            timer.cancel()
+        self.idle = {}
+        self.idle_timers = {}
+
+
+class StdioSquidHandler(manager.SquidHandler):
+    """
+    Reads Squid's lookups from stdin and answers them on stdout.
+    """
+    max_line = 65536
+
+    def __init__(self, manager_, loop):
+        manager.SquidHandler.__init__(self, manager_)
+        self.loop = loop
+        self.transport = None
+
+    async def serve(self):
+        if _pollable(sys.stdout):
+            self.transport, _ = await self.loop.connect_write_pipe(
+                asyncio.Protocol, sys.stdout
+            )
+        if _pollable(sys.stdin):
+            reader = asyncio.StreamReader(limit=self.max_line)
+            await self.loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
+            )
+            readline = lambda: _read_line(reader)
+        else:
+            readline = lambda: self.loop.run_in_executor(
+                None, _read_file_line, sys.stdin.buffer, self.max_line
+            )
+        while True:
+            line, too_long = await readline()
+            if too_long:
+                self.line_too_long(manager._native(line))
+                continue
+            if not line:
+                break
+            self.line_received(manager._native(line))
+        self.manager.shutdown()
+
+    def write(self, data):
+        if self.transport is None:
+            sys.stdout.buffer.write(manager._encode(data))
+            sys.stdout.buffer.flush()
+        else:
+            self.transport.write(manager._encode(data))
+
+async def _read_line(reader):
+    """
+    Read a line, returning it and whether it was longer than reader's
+    limit; if it was, only its start is returned, and the rest is thrown
+    away.
+    """
+    try:
+        return await reader.readuntil(b"\n"), False
+    except asyncio.IncompleteReadError as why:
+        return why.partial, False  # end of input
+    except asyncio.LimitOverrunError as why:
+        start = await reader.readexactly(why.consumed)
+    while True:
+        try:
+            await reader.readuntil(b"\n")
+            break
+        except asyncio.IncompleteReadError:
+            break
+        except asyncio.LimitOverrunError as why:
+            await reader.readexactly(why.consumed)
+    return start, True
+
+def _read_file_line(f, limit):
+    """
+    As _read_line, from a (blocking) file.
+    """
+    line = f.readline(limit)
+    if len(line) < limit or line.endswith(b"\n"):
+        return line, False
+    while True:
+        rest = f.readline(limit)
+        if not rest or rest.endswith(b"\n"):
+            break
+    return line, True
+
+def _pollable(f):
+    """
+    Whether f can be watched by the loop, rather than (e.g.) being a file.
+    """
+    mode = os.fstat(f.fileno()).st_mode
+    return stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)
+
+
+async def serve_metrics(manager_, reader, writer):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(manager_.metrics.http_response(manager_))
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+            ConnectionError):
+        pass
+    writer.close()
+
+def listen_metrics(manager_, address):
+    """
+    Serve metrics on address; a path for a Unix socket, or host:port.
+    """
+    listen(manager_, address,
+        lambda reader, writer: serve_metrics(manager_, reader, writer)
+    )
+
+async def serve_push(receiver, reader, writer):
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = manager._native(head).split("\r\n")
+        headers = {}
+        for line in lines[1:]:
+            if line.strip():
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            length = -1
+        if 'transfer-encoding' in headers:
+            response = receiver.response(411, "Content-Length needed")
+        elif not 0 <= length <= receiver.max_size:
+            response = receiver.response(413, "Too large")
+        else:
+            body = await reader.readexactly(length)
+            response = receiver.handle(lines[0], headers, body)
+        writer.write(response)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+            ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+def listen_push(manager_, address):
+    """
+    Take pushed events on address; a path for a Unix socket, or host:port.
+    """
+    receiver = manager.PushReceiver(manager_)
+    listen(manager_, address,
+        lambda reader, writer: serve_push(receiver, reader, writer)
+    )
+
+def listen(manager_, address, handler):
+    if "/" in address:
+        try:
+            if stat.S_ISSOCK(os.stat(address).st_mode):
+                os.remove(address)
+        except OSError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(address)
+        server = asyncio.start_unix_server(handler, sock=sock)
+    else:
+        host, port = address.rsplit(":", 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, int(port)))  # not create_server(); that's 3.8+
+        server = asyncio.start_server(handler, sock=sock)
+    manager_.reactor.starting.append(server)
+
+
+def profile_on_signal(manager_, profiler):
+    """
+    As manager.profile_on_signal(), on the loop.
+    """
+    for signum, kind in [(signal.SIGUSR1, "cpu"), (signal.SIGUSR2, "memory")]:
+        manager_.reactor.loop.add_signal_handler(signum, profiler.toggle, kind)
+
+
+def setup(config):
+    """
+    Return a ChannelManager that runs on asyncio and answers Squid on
+    stdin/stdout once it's started.
+    """
+    if uvloop is not None:
+        loop = uvloop.new_event_loop()
+    else:
+        loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    cm = manager.ChannelManager(
+        LoopReactor(loop), config, AsyncioFetcher(loop, config)
+    )
+    cm.reactor.starting.append(StdioSquidHandler(cm, loop).serve())
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+        loop.add_signal_handler(signum, cm.shutdown)
+    return cm
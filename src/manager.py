@@ -8,25 +8,33 @@ This program is designed to run as a single external_refresh_check handler
  for Squid; the configuration line MUST look like this:
   external_refresh_check children=1 concurrency=99 %CACHE_URI %AGE %RES{Cache-Control} %RES{Link} /path/to/this/program /path/to/conf/file
 
-In particular, children MUST NOT be more than "1".
+In particular, children MUST NOT be more than "1", unless shared_dir is
+configured. In that case, the children only answer Squid, from state that 
+they share with a separate poller process (started by the first child to
+need it, or by running this program with --poller) which does all of the 
+channel fetching.
 
-It requires Python 2.3+ and the following additional libraries:
- - Twisted <http://twistedmatrix.com/>
+It requires Python 2.7+ (or 3) and the following additional libraries:
+ - Twisted 16.0+ <http://twistedmatrix.com/>
  - Dateutil <http://labix.org/python-dateutil>
 
+With engine = asyncio (Python 3.7+ only), channels are fetched and Squid
+is answered from an asyncio event loop instead; see aio_engine.py. uvloop
+<https://github.com/MagicStack/uvloop> is used for it if installed.
+
 See the sample configuration file for details of its content.
 
 It's a really good idea to configure a HTTP proxy, because;
- - This process doesn't use persistent connections, whereas most HTTP 
-   proxies (e.g., squid on localhost) will.
- - The only state that's kept between invocations is the list of channels 
-   being monitored, not their contents; using a caching proxy will make 
-   startup and restarts more efficient (so that the entire channel 
-   contents don't have to be re-read across the network).
+ - Unless statefile is configured, the only state that's kept between 
+   invocations is the list of channels being monitored, not their contents; 
+   using a caching proxy will make startup and restarts more efficient (so 
+   that the entire channel contents don't have to be re-read across the 
+   network).
  - If your cache is tied together with others (e.g., using ICP), it will 
    reduce the load on the server that hosts the channel.
- - DNS in twisted is synchronous (?); using a proxy will offload any potential 
-   blocking to another process.
+ - Without one, this program looks up channel hosts itself; it does so 
+   asynchronously and caches the results (see dns_ttl), but a proxy will 
+   usually have a better cache.
 
 Usually, this means pointing this program at the Squid that it's managing 
 channels for. However, if it's set up as an accelerator, you can either 
@@ -37,10 +45,12 @@ this purpose nearby.
 To take full advantage of this, make sure that your channels' feed 
 documents are cacheable.
 
-Note that logging is synchronous (because it writes to disk), and 
-therefore can slow down this process. As a result, we use the response 
-to Squid to log most runtime events; debugging is log-intensive and 
-should not be turned on in production.
+Note that logging is synchronous (because it writes to disk) unless 
+log_queue is configured, and therefore can slow down this process. As a 
+result, we use the response to Squid to log most runtime events; debugging 
+is log-intensive and should not be turned on in production without 
+log_queue. Log calls pass their arguments separately, so that filtered 
+messages aren't formatted.
   
 Maintainers: Note that only one instance runs per Squid process, and that 
 it can handle concurrent requests. It is an asynchronous process (i.e., 
@@ -76,124 +86,635 @@ import sys
 import re
 import time
 import calendar
+import math
+import random
+import heapq
+import bisect
 import logging
-import ConfigParser
-import xml.dom.minidom
-from urllib import unquote
-from urlparse import urljoin
+import struct
+import socket
+import hashlib
+import zlib
+import gc
+import signal
+import cProfile
+import pstats
+from array import array
+import mmap
+import subprocess
+import threading
+from collections import deque
+try:
+    import ConfigParser as configparser
+    from ConfigParser import SafeConfigParser as ConfigParser
+except ImportError:
+    import configparser
+    from configparser import ConfigParser
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # Python 2
+try:
+    from urllib import unquote
+    from urlparse import urljoin, urlsplit
+except ImportError:
+    from urllib.parse import unquote, urljoin, urlsplit
 from xml.parsers import expat
 from logging.handlers import RotatingFileHandler
-from twisted.internet import reactor, stdio
-from twisted.protocols.basic import LineReceiver
+from twisted.internet import reactor, stdio, protocol, defer
 from twisted.internet import error as internet_error
+from twisted.internet.endpoints import TCP4ClientEndpoint, wrapClientTLS
+from twisted.names import client as names_client, dns
+from twisted.names import hosts as names_hosts
+from twisted.names.resolve import ResolverChain
+from twisted.protocols.basic import LineReceiver
 from twisted.web import client
-from twisted.web import error as web_error
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
 from dateutil import parser  # http://labix.org/python-dateutil
 
+try:
+    xrange
+except NameError:
+    xrange = range
+
+# _native() turns bytes off the wire into str; _encode() goes the other way
+if str is bytes:
+    def _native(data):
+        return data
+
+    def _encode(s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        return s
+else:
+    def _native(data):
+        return data.decode('utf-8', 'surrogateescape')
+
+    def _encode(s):
+        if isinstance(s, str):
+            s = s.encode('utf-8', 'surrogateescape')
+        return s
+
+if hasattr(array, 'tobytes'):
+    array_to_bytes, array_from_bytes = array.tobytes, array.frombytes
+else:
+    array_to_bytes, array_from_bytes = array.tostring, array.fromstring
+
 # FIXME: incompatible with stale-while-revalidate?
-# TODO: HTTP authentication, validation
-# TODO: GC old feeds?
-# TODO: hash URIs for space?
+# TODO: HTTP authentication
 
 class ChannelManager:
-    def __init__(self, reactor_, config):
+    def __init__(self, reactor_, config, fetcher=None):
         self.reactor = reactor_
         self.config = config
+        self.extend_pct = config.getint("main", "extend_pct")
+        self.channel_idle_timeout = config.getint(
+            "main", "channel_idle_timeout"
+        )
+        self.max_channels = config.getint("main", "max_channels")
+        self.max_events = config.getint("main", "max_events")
         self.channels = {}
+        self.publisher = None  # StatePublisher, when serving children
+        self.checking = {}  # channel_uri: (when its check started, reread)
+        self.refused = {}  # channel_uri: why it wasn't added, since idle_check
+        self.event_count = 0  # events held by all channels
+        self.metrics = Metrics()
+        if fetcher is None:
+            fetcher = Fetcher(reactor_, config)
+        self.fetcher = fetcher
+        self.scheduler = PollScheduler(
+            reactor_, self._check, 
+            jitter=config.getint("main", "poll_jitter") / 100.0
+        )
         self.error_check = 30  # how often to look to see if an error has cleared (seconds)
-        self.gc_period = 60 * 60 * 24  # how often to garbage collect old entries
+        self.gc_period = 5  # how often to garbage collect old entries
+        self.gc_slice = 10000  # how many entries to look at each time
+        self.idle_check = 60  # how often to look for idle channels (seconds)
+        self.max_refused = 1000  # most refused channels to remember
+        self.reread_period = 3600  # least time between full rereads of a channel over max_events (seconds)
         self.min_check_time = 5  # minimum number of seconds between checks
+        self.max_backoff_doublings = 10  # most times to double error retries
+        self.startup_spread = 10  # seconds to spread startup checks over
+        self.state_version = 1  # format of the state snapshot
+        self.snapshot_pid = None  # of the process writing a snapshot
+        self.snapshot_poll = 1  # how often to see if it's finished (seconds)
+        self.state_keys = [  # channel members kept in the state snapshot
+            'events', 'prefixes', 'newest_event', 'precision', 'lifetime',
+            'last_archive_seen', 'last_check', 'validators', 'last_lookup',
+            'events_refused'
+        ]
 
     def start(self):
         logging.info("start_manager")
+        self._load_state()
         try:
             db = open(self.config.get("main", "dbfile"), 'r')
             for line in db:
-                self.add_channel(line.strip())
+                self.add_channel(line.strip(), self.startup_spread, 1.0)
             db.close()
-        except IOError, why:
-            logging.info("db_read_error (%s)" % why)
+        except IOError as why:
+            logging.info("db_read_error (%s)", why)
+        self.scheduler.start()
         self.reactor.callLater(self.gc_period, self._gc)            
+        self.reactor.callLater(self.idle_check, self._evict_idle)
+        if self.config.get("main", "statefile"):
+            self.reactor.callLater(
+                self.config.getint("main", "state_period"), self._snapshot
+            )
         self.reactor.run()
 
     def shutdown(self):
         logging.info("stop_manager")
+        self.fetcher.close()
         self.reactor.stop()
+        self.save()
+
+    def save(self):
         try:
             db = open(self.config.get("main", "dbfile"), 'w')
             for channel_uri in self.channels.keys():
                 db.write("%s\n" % channel_uri)
             db.close()
-        except IOError, why:
-            logging.critical("db_write_error (%s)" % why)
-                        
-    def add_channel(self, channel_uri):
-        if not channel_uri in self.channels.keys():
-            self.channels[channel_uri] = {'uri': channel_uri}
-            self._schedule_check(channel_uri)
-            logging.info("new_channel_added <%s>" % channel_uri)
-                
-    def _schedule_check(self, channel_uri, when=0):
-        def check():
-            channel = self.channels[channel_uri]
-            c = AtomChannel(
-                channel, self._check_done, self._check_error, self.config
+        except IOError as why:
+            logging.critical("db_write_error (%s)", why)
+        self._save_state()
+
+    def _load_state(self):
+        statefile = self.config.get("main", "statefile")
+        if not statefile:
+            return
+        try:
+            fh = open(statefile, 'rb')
+            try:
+                state = pickle.load(fh)
+            finally:
+                fh.close()
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError) as why:
+            logging.info("state_read_error (%s)", why)
+            return
+        if state.get('version', None) != self.state_version:
+            logging.warning("state_version_mismatch (%s)",
+                state.get('version', None)
+            )
+            return
+        for channel_uri, channel in state['channels'].items():
+            channel['uri'] = channel_uri
+            channel.setdefault('last_lookup', time.time())
+            self._convert_events(channel)
+            self.channels[channel_uri] = channel
+            wait = 0
+            if 'last_check' in channel and 'precision' in channel:
+                set_verdict(channel, self.extend_pct)
+                wait = channel['last_check'] - time.time() + \
+                    self._check_interval(channel['precision'])
+            if wait > 0:
+                self._schedule_check(channel_uri, wait)
+            else:
+                self._schedule_check(channel_uri, self.startup_spread, 1.0)
+        self._count_events()
+        logging.info("state_loaded %i channels (saved %2.2f)",
+            len(state['channels']), state['time']
+        )
+
+    def _convert_events(self, channel):
+        events = channel.get('events', None)
+        store = EVENT_STORES[self.config.get("main", "event_store")]
+        if events is None or events.__class__ is store:
+            return
+        if isinstance(events, dict):
+            channel['events'] = store()
+            channel['events'].update(events)
+        else:
+            # can't get URIs back out of a hashed store; re-read the channel
+            logging.info("state_events_dropped <%s>", channel['uri'])
+            for k in ['events', 'newest_event', 'last_archive_seen', 
+                      'last_check', 'validators']:
+                if k in channel:
+                    del channel[k]
+
+    def _save_state(self):
+        statefile = self.config.get("main", "statefile")
+        if not statefile:
+            return
+        if self.snapshot_pid is not None:
+            # don't let an older snapshot replace this one
+            try:
+                os.waitpid(self.snapshot_pid, 0)
+            except OSError:
+                pass
+            self.snapshot_pid = None
+        try:
+            count = self._write_state(statefile)
+        except (IOError, OSError) as why:
+            logging.critical("state_write_error (%s)", why)
+            return
+        logging.debug("state_saved %i channels", count)
+
+    def _write_state(self, statefile):
+        channels = {}
+        for channel_uri, channel in self.channels.items():
+            channels[channel_uri] = dict([
+                (k, channel[k]) for k in self.state_keys if k in channel
+            ])
+        state = {
+            'version': self.state_version,
+            'time': time.time(),
+            'channels': channels,
+        }
+        tmpfile = "%s.%i.tmp" % (statefile, os.getpid())
+        fh = open(tmpfile, 'wb')
+        try:
+            pickle.dump(state, fh, pickle.HIGHEST_PROTOCOL)
+            fh.flush()
+            os.fsync(fh.fileno())
+        finally:
+            fh.close()
+        os.rename(tmpfile, statefile)
+        return len(channels)
+
+    def _snapshot(self):
+        """
+        Save state periodically from a forked child, so that pickling and
+        writing it doesn't hold up answers to Squid; the child gets a
+        consistent copy of the channels for free.
+        """
+        self.reactor.callLater(
+            self.config.getint("main", "state_period"), self._snapshot
+        )
+        statefile = self.config.get("main", "statefile")
+        if not hasattr(os, 'fork'):
+            self._save_state()
+            return
+        if self.snapshot_pid is not None:
+            logging.warning("state_save_busy")
+            return
+        pid = os.fork()
+        if pid == 0:
+            # no logging here; its locks may be held by other threads
+            status = 1
+            try:
+                self._write_state(statefile)
+                status = 0
+            finally:
+                os._exit(status)
+        self.snapshot_pid = pid
+        self.reactor.callLater(self.snapshot_poll, self._reap_snapshot)
+
+    def _reap_snapshot(self):
+        if self.snapshot_pid is None:
+            return  # save() waited for it
+        try:
+            pid, status = os.waitpid(self.snapshot_pid, os.WNOHANG)
+        except OSError as why:  # e.g., reaped by someone else
+            self.snapshot_pid = None
+            logging.warning("state_save_unknown (%s)", why)
+            return
+        if pid == 0:
+            self.reactor.callLater(self.snapshot_poll, self._reap_snapshot)
+            return
+        self.snapshot_pid = None
+        if status:
+            logging.critical("state_write_error (snapshot process status %i)",
+                status
             )
-            logging.debug("checking <%s>" % channel_uri)
+        else:
+            logging.debug("state_saved %i channels", len(self.channels))
+
+    def add_channel(self, channel_uri, when=0, jitter=None):
+        """
+        Start monitoring a channel, unless that would go over max_channels
+        or max_events; if so, returns which.
+        """
+        if channel_uri in self.channels:
+            return None
+        if self.max_channels and len(self.channels) >= self.max_channels:
+            refused = "max_channels"
+        elif self.max_events and self.event_count >= self.max_events:
+            refused = "max_events"
+        else:
+            self.channels[channel_uri] = {
+                'uri': channel_uri, 'last_lookup': time.time()
+            }
+            self._schedule_check(channel_uri, when, jitter)
+            logging.info("new_channel_added <%s>", channel_uri)
+            return None
+        if channel_uri not in self.refused and \
+        len(self.refused) < self.max_refused:
+            logging.warning("channel_refused <%s> %s", channel_uri, refused)
+            self.refused[channel_uri] = refused
+            if self.publisher:
+                self.publisher.publish_index()
+        return refused
+
+    def remove_channel(self, channel_uri):
+        """
+        Stop monitoring a channel, and forget its events.
+        """
+        channel = self.channels.pop(channel_uri, None)
+        if channel is None:
+            return
+        self.scheduler.cancel(channel_uri)
+        self.fetcher.cancel(channel_uri)
+        self.checking.pop(channel_uri, None)
+        if self.publisher:
+            self.publisher.remove(channel_uri)
+        logging.info("channel_removed <%s>", channel_uri)
+                
+    def _schedule_check(self, channel_uri, when=0, jitter=None):
+        logging.debug("schedule_check <%s> %2.2f", channel_uri, when)
+        self.scheduler.schedule(channel_uri, when, jitter)
+
+    def want_channel(self, channel_uri):
+        """
+        Squid is waiting on a channel that hasn't been checked yet; get to 
+        it before others.
+        """
+        channel = self.channels.get(channel_uri, None)
+        if channel is None or 'wanted' in channel:
+            return
+        channel['wanted'] = True
+        if channel_uri in self.checking:
+            self.fetcher.promote(channel_uri)
+        else:
+            self._schedule_check(channel_uri, 0, 0)
+
+    def push_events(self, channel_uri, events, prefix_events=()):
+        """
+        Apply stale events pushed by a channel's publisher, returning how
+        many were new, or None if the channel isn't being monitored.
+        Polling still reads them (and any that weren't pushed) later.
+        """
+        channel = self.channels.get(channel_uri, None)
+        if channel is None:
+            return None
+        c = AtomChannel(channel, None, None, self.config, self.fetcher,
+            self.event_room
+        )
+        added = c.add_events(events, prefix_events, pushed=True)
+        self.metrics.pushed_events += added
+        logging.info("events_pushed <%s> %i", channel_uri, added)
+        if c.events_refused:
+            channel['events_refused'] = time.time()
+            if 'last_check' in channel:
+                set_verdict(channel, self.extend_pct)
+        if (added or c.events_refused) and self.publisher:
+            self.publisher.publish(channel)
+        return added
+
+    def event_room(self, wanted):
+        """
+        Return how many of wanted new events fit under max_events, and
+        count them as held.
+        """
+        room = wanted
+        if self.max_events:
+            room = max(min(wanted, self.max_events - self.event_count), 0)
+            self.metrics.refused_events += wanted - room
+        self.event_count += room
+        return room
+
+    def _forget_reads(self, channel):
+        """
+        Make a check read the whole channel again, because some of its
+        events couldn't be kept.
+        """
+        for k in ['validators', 'newest_event', 'last_archive_seen']:
+            if k in channel:
+                del channel[k]
+
+    def _check(self, channel_uri):
+        channel = self.channels.get(channel_uri, None)
+        if channel is None:
+            return
+        now = time.time()
+        # rereading a channel over max_events is the only way to clear
+        # it, but refetches its whole archive, so is rationed
+        reread = channel.get('events_refused', False) and \
+            now - channel.get('last_reread', 0) >= self.reread_period and \
+            (not self.max_events or self.event_count < self.max_events)
+        if reread:
+            self._forget_reads(channel)
+            channel['last_reread'] = now
+        self.checking[channel_uri] = (now, reread)
+        c = AtomChannel(
+            channel, self._check_done, self._check_error, self.config,
+            self.fetcher, self.event_room
+        )
+        logging.debug("checking <%s>", channel_uri)
+        try:
             c.check()
-        logging.debug("schedule_check <%s> %2.2f" % (channel_uri, when))
-        self.reactor.callLater(when, check)
+        except Exception as why:
+            self._check_error(channel, '"Unknown error (%s: %s)"' % (
+                why.__class__.__name__, why
+            ))
+
+    def _check_interval(self, precision, elapsed=0):
+        return (precision - elapsed) * \
+            ((100 - self.extend_pct) / 100.0 )
 
-    def _check_done(self, channel):
+    def _check_done(self, channel, events_refused=False):
+        """
+        A check has read the channel; events_refused says whether any of
+        its events didn't fit under max_events. channel['events_refused']
+        (when the last were refused) is only cleared by a check that reread
+        the whole channel and kept everything, and that started after
+        it was set (e.g., by a push); failed checks leave it alone.
+        """
+        if channel['uri'] not in self.channels:
+            return  # removed while it was being checked
         now = time.time()
         channel['last_check'] = now
+        started, reread = self.checking.pop(channel['uri'], (now, False))
+        if events_refused:
+            channel['events_refused'] = now
+        elif reread and channel.get('events_refused', 0) < started:
+            channel.pop('events_refused', None)
+        set_verdict(channel, self.extend_pct)
+        for k in ['failures', 'wanted']:
+            if k in channel:
+                del channel[k]
         self.channels[channel['uri']] = channel
-        logging.debug("check_done <%s> %2.2f" % (
+        logging.debug("check_done <%s> %2.2f",
             channel['uri'], channel['last_check_elapsed']
-        ))
+        )
+        self.metrics.check_seconds.observe(channel['last_check_elapsed'])
+        if self.publisher:
+            self.publisher.publish(channel)
         wait = max(
-            (channel['precision'] - channel.get('last_check_elapsed', 0)) * \
-            ((100 - self.config.getint('main', 'extend_pct')) / 100.0 ),
+            self._check_interval(
+                channel['precision'], channel.get('last_check_elapsed', 0)
+            ),
             self.min_check_time
         )
         if wait == self.min_check_time:
-            logging.warning("check_delay <%s>; using min_check_time" % \
+            logging.warning("check_delay <%s>; using min_check_time",
                 channel['uri']
             )
         self._schedule_check(channel['uri'], wait)
 
     def _check_error(self, channel, message=""):
-        logging.warning("check_error <%s> %s" % (channel['uri'], message))
+        if channel['uri'] not in self.channels:
+            return
+        logging.warning("check_error <%s> %s", channel['uri'], message)
+        self.metrics.check_errors += 1
+        self.checking.pop(channel['uri'], None)
+        failures = channel.get('failures', 0) + 1
+        channel['failures'] = failures
+        wait = min(
+            self.min_check_time * 2 ** min(
+                failures - 1, self.max_backoff_doublings
+            ),
+            channel.get('precision', self.error_check)
+        )
+        if 'last_check' in channel and 'precision' in channel:
+            # try again before the channel would be considered dead
+            left = channel['last_check'] + channel['precision'] - \
+                time.time() - self.config.getint("main", "fetch_timeout")
+            if left > 0:
+                wait = min(wait, left)
         self._schedule_check(
-            channel['uri'], 
-            channel.get('precision', self.error_check )
-        ) # TODO: back-off algorithm
+            channel['uri'], max(wait, self.min_check_time)
+        )
 
     def _gc(self):
-        logging.info("garbage_collection")
         now = time.time()
-        for ck in self.channels:
-            lifetime = self.channels[ck].get('lifetime', None)
+        budget = self.gc_slice
+        self._count_events()
+        for ck in self.channels.keys():
+            if budget <= 0:
+                break
+            channel = self.channels[ck]
+            lifetime = channel.get('lifetime', None)
             if not lifetime:
-                logging.info("no_lifetime <%s>" % self.channels[ck]['uri'])
                 continue
-            for k, v in self.channels[ck]['events'].items():
-                if v < (now - lifetime):
-                    del self.channels[ck]['events'][k]
-                    logging.debug("gc_event <%s> <%s> %s" % (ck, k, v))            
+            for events in [channel.get('events'), channel.get('prefixes')]:
+                if events is None:
+                    continue
+                indexed = len(events.wheel)
+                count = events.expire(now - lifetime, budget)
+                budget -= indexed - len(events.wheel)
+                if count:
+                    logging.debug("gc_events <%s> %i", ck, count)
         self.reactor.callLater(self.gc_period, self._gc)
 
+    def _count_events(self):
+        event_count = 0
+        for channel in self.channels.values():
+            for k in ['events', 'prefixes']:
+                event_count += len(channel.get(k, None) or ())
+        self.event_count = event_count
+
+    def _evict_idle(self):
+        """
+        Remove channels that Squid hasn't asked about for
+        channel_idle_timeout, and give refused channels another chance.
+        """
+        if self.channel_idle_timeout:
+            idle_since = time.time() - self.channel_idle_timeout
+            for channel_uri, channel in list(self.channels.items()):
+                if channel.get('last_lookup', idle_since) < idle_since:
+                    logging.info("channel_idle <%s>", channel_uri)
+                    self.metrics.evicted_channels += 1
+                    self.remove_channel(channel_uri)
+        if self.refused:
+            self.refused = {}
+            if self.publisher:
+                self.publisher.publish_index()
+        self.reactor.callLater(self.idle_check, self._evict_idle)
+
+
+class PollScheduler:
+    """
+    Runs channel checks from one timer that ticks every tick seconds,
+    rather than from a DelayedCall per channel.
+
+    Each check is brought forward by up to jitter (a fraction of its
+    delay), so that checks scheduled together drift apart.
+    """
+    def __init__(self, reactor_, check_cb, tick=1.0, jitter=0.1):
+        self.reactor = reactor_
+        self.check_cb = check_cb
+        self.tick = tick
+        self.jitter = jitter
+        self.slots = {}  # tick number: {channel_uri: True}
+        self.due = {}  # channel_uri: tick number
+        self.last_tick = int(time.time() / tick)
+
+    def __len__(self):
+        return len(self.due)
+
+    def start(self):
+        self.reactor.callLater(self.tick, self._run)
+
+    def schedule(self, channel_uri, when, jitter=None):
+        if jitter is None:
+            jitter = self.jitter
+        when = when - when * jitter * random.random()
+        slot = max(int((time.time() + when) / self.tick), self.last_tick + 1)
+        self.cancel(channel_uri)
+        self.due[channel_uri] = slot
+        self.slots.setdefault(slot, {})[channel_uri] = True
+
+    def cancel(self, channel_uri):
+        slot = self.due.pop(channel_uri, None)
+        if slot is not None:
+            del self.slots[slot][channel_uri]
+            if not self.slots[slot]:
+                del self.slots[slot]
+
+    def _run(self):
+        self.reactor.callLater(self.tick, self._run)
+        now_tick = int(time.time() / self.tick)
+        if now_tick - self.last_tick > len(self.slots):
+            ready = [s for s in self.slots.keys() if s <= now_tick]
+            ready.sort()
+        else:
+            ready = xrange(self.last_tick + 1, now_tick + 1)
+        self.last_tick = now_tick
+        for slot in ready:
+            for channel_uri in self.slots.pop(slot, {}).keys():
+                del self.due[channel_uri]
+                try:
+                    self.check_cb(channel_uri)
+                except Exception as why:
+                    logging.warning("check_failed <%s> (%s: %s)",
+                        channel_uri, why.__class__.__name__, why
+                    )
+
 
 class AtomChannel:
-    def __init__(self, channel, done_cb, error_cb, config):
+    def __init__(self, channel, done_cb, error_cb, config, fetcher,
+                 event_room=None):
         self.channel = channel
+        self.event_room = event_room  # see ChannelManager.event_room
         self.done_cb = done_cb
         self.error_cb = error_cb
         self.config = config
+        self.fetcher = fetcher
         self.default_precision = 60
         self.default_lifetime = 604800
         self.archives_requested = []
         self.archives_seen = []
+        self.validators = {}  # uri: (etag, last_modified, prev_archive_uri)
+        self.response_validators = {}
+        self.prefetched = {}  # archive uri: _PendingFetch
+        self.prefetch_template = None  # (before, after) the archive number
+        self.prefetch_next = None  # next archive number to prefetch
+        self.prefetch_floor = -1  # archive numbers at or below are seen
+        self.events_refused = False  # whether any didn't fit in event_room
         self.start_time = None
         
     def check(self):
@@ -202,148 +723,387 @@ class AtomChannel:
            req_headers={"Cache-Control": "max-age=%s" % \
                 self.channel.get('precision', self.default_precision)})        
                 
-    def process_sub_doc(self, uri, instr):
-        head_links, md, events = parse_feed(uri, instr)
+    def process_sub_doc(self, uri, instr, coding=None):
+        since = None
+        if self.config.getboolean("main", "early_stop"):
+            since = self.channel.get('newest_event', None)
+        head_links, md, events, prefix_events = parse_feed(
+            uri, instr, since, coding, 
+            self.config.getint("main", "max_document_size")
+        )
+        self.remember_validators(uri, head_links)
         self.channel['lifetime'] = int(
             md["lifetime"] or self.default_lifetime
         )
         self.channel['precision'] = int(
             md["precision"] or self.default_precision
         )
-        self.add_events(events)
+        self.add_events(events, prefix_events)
+        self.start_prefetch(md["archive_num"], head_links.get('prev-archive'))
         self.check_prev(head_links)
 
     def check_prev(self, head_links):
         prev_uri = head_links.get('prev-archive', None)
-        logging.debug("prev_uri <%s>" % prev_uri or "")
+        logging.debug("prev_uri <%s>", prev_uri)
         if prev_uri and prev_uri != \
         self.channel.get('last_archive_seen', None):
             self.archives_requested.append(prev_uri)
             logging.debug("checking prev_uri")
-            self.fetch(prev_uri, self.process_archive, req_headers={
-                "Cache-Control": "max-stale=%s" % self.channel['lifetime']
-            })
+            self.fetch(prev_uri, self.process_archive, 
+                req_headers=self.archive_headers()
+            )
         else:
             self.done()
+
+    def archive_headers(self):
+        return {"Cache-Control": "max-stale=%s" % self.channel['lifetime']}
+
+    def start_prefetch(self, archive_num, prev_uri):
+        """
+        If the channel says which archive number it's at and the prev-archive
+        URI contains the number before it, guess the URIs of older archives
+        and start fetching them. They're only used if the walk through 
+        prev-archive links gets to them.
+        """
+        try:
+            archive_num = int(archive_num)
+        except (TypeError, ValueError):
+            return
+        if not prev_uri or archive_num < 2 or \
+        not self.config.getint("main", "archive_prefetch"):
+            return
+        prev_num = str(archive_num - 1)
+        if prev_uri.count(prev_num) != 1:
+            return
+        before, after = prev_uri.split(prev_num)
+        self.prefetch_template = (before, after)
+        self.prefetch_next = archive_num - 2
+        last_seen = self.channel.get('last_archive_seen', None)
+        if last_seen and len(last_seen) > len(before) + len(after) and \
+        last_seen.startswith(before) and last_seen.endswith(after):
+            try:
+                self.prefetch_floor = int(
+                    last_seen[len(before):len(last_seen) - len(after)]
+                )
+            except ValueError:
+                pass
+        self.prefetch_more()
+
+    def prefetch_more(self):
+        if self.prefetch_template is None:
+            return
+        before, after = self.prefetch_template
+        while len(self.prefetched) < \
+        self.config.getint("main", "archive_prefetch") and \
+        self.prefetch_next > self.prefetch_floor:
+            uri = "%s%i%s" % (before, self.prefetch_next, after)
+            self.prefetch_next -= 1
+            logging.debug("prefetch <%s>", uri)
+            pending = self.prefetched[uri] = _PendingFetch()
+            self.request(
+                uri, self.archive_headers(), pending.callback, pending.errback
+            )
+
+    def stop_prefetch(self):
+        self.prefetch_template = None
+        if self.prefetched:
+            self.fetcher.cancel(self.channel['uri'], self.prefetched)
+        self.prefetched = {}  # results that still arrive are dropped
     
-    def process_archive(self, uri, instr):
-        head_links, md, events = parse_feed(uri, instr)
-        self.add_events(events)
+    def process_archive(self, uri, instr, coding=None):
+        head_links, md, events, prefix_events = parse_feed(
+            uri, instr, None, coding, 
+            self.config.getint("main", "max_document_size")
+        )
+        self.remember_validators(uri, head_links)
+        self.add_events(events, prefix_events)
         self.archives_seen.append(uri)
         self.check_prev(head_links)
 
-    def add_events(self, events):
-        if not self.channel.has_key('events'):
-            logging.debug("empty_event_dict <%s>" % self.channel['uri'])
-            self.channel['events'] = {}
-        for uri, date in events:
-            if date is None:
-                logging.warning("bad_event_date <%s> <%s>" % \
-                    (self.channel['uri'], uri)
+    def not_modified(self, uri, validators):
+        logging.debug("not_modified <%s>", uri)
+        self.validators[uri] = validators
+        if uri != self.channel['uri']:
+            self.archives_seen.append(uri)
+        prev_uri = validators[2]
+        if prev_uri:
+            self.check_prev({'prev-archive': prev_uri})
+        else:
+            self.check_prev({})
+
+    def remember_validators(self, uri, head_links):
+        etag, last_modified = self.response_validators.pop(uri, (None, None))
+        if etag or last_modified:
+            self.validators[uri] = (
+                etag, last_modified, head_links.get('prev-archive', None)
+            )
+
+    def add_events(self, events, prefix_events=(), pushed=False):
+        """
+        Add stale events to the channel, returning how many were new.
+        Pushed events don't move newest_event, so that early_stop still
+        reads the entries that polling hasn't seen yet. Events for new URIs
+        that event_room has no room for are refused, and events_refused
+        is set.
+        """
+        added = 0
+        refused = 0
+        if 'events' not in self.channel:
+            logging.debug("empty_event_dict <%s>", self.channel['uri'])
+            self.channel['events'] = \
+                EVENT_STORES[self.config.get("main", "event_store")]()
+        if prefix_events and 'prefixes' not in self.channel:
+            self.channel['prefixes'] = PathTrie()
+        for store, new_events in [
+            (self.channel['events'], events),
+            (self.channel.get('prefixes', None), prefix_events)
+        ]:
+            for uri, date in new_events:
+                if date is None:
+                    logging.warning("bad_event_date <%s> <%s>",
+                        self.channel['uri'], uri
+                    )
+                    date = time.time()
+                known = store.get(uri, 0)
+                if date <= known:
+                    continue
+                if not known and self.event_room is not None and \
+                not self.event_room(1):
+                    refused += 1
+                    continue
+                store[uri] = date
+                self.channel['events_changed'] = True
+                added += 1
+                if not pushed and date > self.channel.get('newest_event', 0):
+                    self.channel['newest_event'] = date
+                logging.debug("add_event <%s> <%s> %s",
+                    self.channel['uri'], uri, date
                 )
-                date = time.time()
-            if date <= self.channel['events'].get(uri, 0):
-                continue
-            self.channel['events'][uri] = date
-            logging.debug("add_event <%s> <%s> %s" % (
-                self.channel['uri'], uri, date
-            ))
+        if refused:
+            logging.warning("events_refused <%s> %i (max_events)",
+                self.channel['uri'], refused
+            )
+            self.events_refused = True
+        return added
 
     def done(self):
+        self.stop_prefetch()
         self.archives_requested.reverse()
         for archive_uri in self.archives_requested:
             if archive_uri in self.archives_seen:
                 self.channel['last_archive_seen'] = archive_uri
             else:
                 break
+        self.channel['validators'] = self.validators
+        self.channel['archive_depth'] = len(self.archives_seen)
         self.channel['last_check_elapsed'] = time.time() - self.start_time
-        self.done_cb(self.channel)
+        self.done_cb(self.channel, self.events_refused)
 
-    def fetch(self, uri, cb, req_headers=None):
-        def callback(data):
-            cb(uri, data)
-        def errback(data):
-            if data.type == web_error.Error:
-                msg = '"%s"' % data.value
-            elif data.type == internet_error.DNSLookupError:
-                msg = '"DNS lookup error"'
-            elif data.type == internet_error.TimeoutError:
-                msg = '"Timeout"'
-            elif data.type == internet_error.ConnectionRefusedError:
-                msg = '"Connection refused"'
-            elif data.type == internet_error.ConnectError:
-                msg = '"Connection error"'
-            elif data.type == expat.ExpatError:
-                msg = '"XML parsing error (%s)"' % data.value
-            else:
-                msg = '"Unknown error (%s)"' % data.type
-            self.error_cb(self.channel, msg)
-        c = getPage(str(uri), 
-                timeout=self.config.getint("main", "fetch_timeout"), 
-                proxy=self.config.get("main", "http_proxy"),
-                headers=req_headers
+    def error(self, msg):
+        self.stop_prefetch()
+        self.error_cb(self.channel, msg)
+
+    def request(self, uri, req_headers, callback, errback):
+        req_headers = dict(req_headers or {})
+        if self.config.getboolean("main", "compression"):
+            req_headers['Accept-Encoding'] = "gzip, deflate"
+        validators = self.channel.get('validators', {}).get(uri, None)
+        if validators:
+            etag, last_modified, prev_uri = validators
+            if etag:
+                req_headers['If-None-Match'] = etag
+            if last_modified:
+                req_headers['If-Modified-Since'] = last_modified
+        self.fetcher.fetch(str(uri), req_headers, callback, errback,
+            group=self.channel['uri'], urgent='wanted' in self.channel
         )
-        c.addCallback(callback)
-        c.addErrback(errback)
 
+    def fetch(self, uri, cb, req_headers=None):
+        validators = self.channel.get('validators', {}).get(uri, None)
+        def callback(data, res_headers):
+            self.channel['fetched_bytes'] = \
+                self.channel.get('fetched_bytes', 0) + len(data)
+            self.response_validators[uri] = (
+                res_headers.get('etag', [None])[0],
+                res_headers.get('last-modified', [None])[0]
+            )
+            coding = ",".join(res_headers.get('content-encoding', [])) or None
+            try:
+                cb(uri, data, coding)
+            except expat.ExpatError as why:
+                self.error('"XML parsing error (%s)"' % why)
+            except DecodeError as why:
+                self.error('"Decoding error (%s)"' % why)
+            except Exception as why:
+                self.error('"Unknown error (%s: %s)"' % (
+                    why.__class__.__name__, why
+                ))
+        def errback(status, msg):
+            if status == 304 and validators:
+                self.not_modified(uri, validators)
+                return
+            self.error(msg)
+        if uri in self.prefetched:
+            pending = self.prefetched.pop(uri)
+            self.prefetch_more()
+            pending.deliver(callback, errback)
+        else:
+            self.request(uri, req_headers, callback, errback)
+
+class _PendingFetch:
+    """
+    Holds the outcome of a fetch until someone wants it.
+    """
+    def __init__(self):
+        self.outcome = None
+        self.handlers = None
+
+    def callback(self, data, res_headers):
+        self._fire(0, (data, res_headers))
+
+    def errback(self, status, msg):
+        self._fire(1, (status, msg))
+
+    def deliver(self, callback, errback):
+        self.handlers = (callback, errback)
+        if self.outcome is not None:
+            self._fire(*self.outcome)
+
+    def _fire(self, which, args):
+        if self.handlers is None:
+            self.outcome = (which, args)
+        else:
+            self.handlers[which](*args)
 
-class SquidHandlerProtocol(LineReceiver):
-    delimiter = '\n'
+
+def set_verdict(channel, extend_pct):
+    """
+    Work out the parts of SquidHandler's answers for a channel that only
+    change when it's checked: when it will be considered dead, its
+    lifetime, the FRESH answer (less req_id and Date), and why every
+    answer is STALE, if it is.
+    """
+    extend_by = channel['precision'] * (extend_pct / 100.0)
+    refused = None
+    if channel.get('events_refused', False):
+        refused = "channel_over_max_events"
+    channel['verdict'] = (
+        channel['last_check'] + channel['precision'],
+        channel['lifetime'],
+        "%%s FRESH freshness=%s res{Date}=\"%%s\" log=extended_%2.2f" % \
+            (extend_by, extend_by),
+        refused
+    )
+
+class SquidHandler:
+    """
+    Answers Squid's lookups, independently of the I/O engine; subclasses
+    pass each line in to line_received() and implement write().
+    """
     clock_fuzz = 5
 
     def __init__(self, manager):
         self.manager = manager
+        self.header_cache = LRUCache(
+            manager.config.getint("main", "header_cache_size")
+        )
+        self.pending = []  # responses waiting to be written
+        self.burst = {}  # lookup: response (sans req_id) since last write
+        self.metrics = manager.metrics
+        self.metrics.header_cache = self.header_cache
+        self.date_second = None  # when date was last formatted
+        self.date = None
         
-    def lineReceived(self, line):
+    def line_received(self, line):
         line = line.rstrip()
-        logging.debug('handler_request %s' % line)
-        result = self.process(line)
-        sys.stdout.write("%s\n" % result)
-        sys.stdout.flush()
-        logging.debug("handler_response %s" % result)
+        logging.debug('handler_request %s', line)
+        try:
+            req_id, lookup = line.split(None, 1)
+        except ValueError:
+            result = self.timed_process(line)
+        else:
+            if lookup in self.burst:
+                result = req_id + self.burst[lookup]
+            else:
+                result = self.timed_process(line)
+                self.burst[lookup] = result[len(req_id):]
+        self.respond(result)
 
-    def connectionLost(self, reason):
-        self.manager.shutdown()
+    def line_too_long(self, start):
+        """
+        Answer a line that was too long to read, given how it started.
+        """
+        logging.warning("handler_line_too_long %s", start[:80])
+        try:
+            req_id = start.split(None, 1)[0]
+        except IndexError:
+            return  # nothing to answer it with
+        self.respond("%s STALE log=malformed_line_error" % req_id)
+
+    def respond(self, result):
+        self.metrics.count_verdict(result)
+        if not self.pending:
+            self.manager.reactor.callLater(0, self.write_pending)
+        self.pending.append(result)
+        logging.debug("handler_response %s", result)
+
+    def write_pending(self):
+        self.write("%s\n" % "\n".join(self.pending))
+        self.pending = []
+        self.burst = {}
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def timed_process(self, line):
+        start = time.time()
+        result = self.process(line)
+        self.metrics.lookup_seconds.observe(time.time() - start)
+        return result
 
     def process(self, line):
         try:
             req_id, request_uri, age, cc_str, link_str = line.split(None, 4)
             age = int(age)
-            cc = parse_cc(unquote(cc_str))
-            links = parse_link(unquote(link_str))
+            channel_maxage, channel_uri, group_uris = \
+                self.parse_headers(request_uri, cc_str, link_str)
         except (IndexError, ValueError): 
             return "%s STALE log=malformed_line_error" % line.split(None)[0]
         STALE = "%s STALE log=%%s" % req_id
-        channel_maxage = cc.get('channel-maxage', None)
         if channel_maxage is None:
             return STALE % "no_channel_maxage"
-        channel_uri = cc.get('channel', None)
         if channel_uri is None:
             return STALE % "no_channel_advertised"
-        channel_uri = urljoin(request_uri, channel_uri)
         try:
             channel = self.manager.channels[channel_uri]
         except KeyError:
-            self.manager.add_channel(channel_uri)
+            refused = self.manager.add_channel(channel_uri)
+            if refused:
+                return STALE % ("channel_refused_%s" % refused)
+            self.manager.want_channel(channel_uri)
             return STALE % "channel_not_monitored"
-        if not channel.has_key('last_check'):
-            return STALE % "channel_startup"
         now = time.time() 
-        if now > channel['last_check'] + channel['precision']:
+        channel['last_lookup'] = now
+        verdict = channel.get('verdict', None)
+        if verdict is None:
+            self.manager.want_channel(channel_uri)
+            return STALE % "channel_startup"
+        deadline, lifetime, fresh, refused = verdict
+        if refused:
+            return STALE % refused
+        if now > deadline:
             return STALE % "channel_dead"
         events = channel.get('events', {})
         response_cached = now - age - self.clock_fuzz
-        if events.has_key(request_uri) and \
+        if request_uri in events and \
         events[request_uri] > response_cached:
             return STALE % "invalidated_request_uri"
-        for group_uri, params in links.items():
-            if params.get('rev', "").lower() != 'invalidates':
-                continue
-            group_uri = urljoin(request_uri, group_uri)
-            logging.debug("group_uri <%s> rev %s" % (
-                group_uri, params['rev']
-            ))
-            if events.has_key(group_uri) and \
+        prefixes = channel.get('prefixes', None)
+        if prefixes and prefixes.match(request_uri) > response_cached:
+            return STALE % "invalidated_prefix"
+        for group_uri in group_uris:
+            logging.debug("group_uri <%s>", group_uri)
+            if group_uri in events and \
             events[group_uri] > response_cached:
                 return STALE % "invalidated_group_uri"
         if channel_maxage != True:
@@ -353,14 +1113,713 @@ class SquidHandlerProtocol(LineReceiver):
                 return STALE % "invalid_channel_maxage"
             if age > channel_maxage:
                 return STALE % "channel_maxage"
-        if age > channel['lifetime']:
+        if age > lifetime:
             return STALE % "channel_lifetime"
-        extend_by = channel['precision'] * (
-            self.manager.config.getint('main', 'extend_pct') / 100.0
+        second = int(now)
+        if second != self.date_second:
+            self.date_second = second
+            self.date = time.strftime(
+                '%a, %d %b %Y %H:%M:%S GMT', time.gmtime(second)
+            )
+        return fresh % (req_id, self.date)
+
+    def parse_headers(self, request_uri, cc_str, link_str):
+        base = request_uri.split('?', 1)[0]
+        slash = base.rfind('/')
+        if slash > base.find('//') + 1:
+            base = base[:slash + 1]
+        key = (base, cc_str, link_str)
+        headers = self.header_cache.get(key)
+        if headers is None:
+            headers, cacheable = resolve_headers(request_uri, cc_str, link_str)
+            if cacheable:
+                self.header_cache.set(key, headers)
+        return headers
+
+class SquidHandlerProtocol(LineReceiver, SquidHandler):
+    delimiter = b'\n'
+
+    def __init__(self, manager):
+        SquidHandler.__init__(self, manager)
+
+    def lineReceived(self, line):
+        self.line_received(_native(line))
+
+    def write(self, data):
+        self.transport.write(_encode(data))
+
+    def connectionLost(self, reason):
+        self.manager.shutdown()
+
+
+## event stores; map URIs to the time they were last made stale
+
+class ExpiryWheel:
+    """
+    Remembers event keys in coarse buckets by event time, so that those
+    that may have expired can be found without looking at all of them.
+    Keys aren't removed when their event is updated or deleted, so
+    callers need to check what pop() gives them.
+    """
+    granularity = 60  # seconds per bucket
+
+    def __init__(self, bucket_factory=list):
+        self.bucket_factory = bucket_factory
+        self.buckets = {}  # bucket start time: keys
+        self.starts = []  # heap of bucket start times
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def add(self, when, key):
+        start = int(when) - int(when) % self.granularity
+        bucket = self.buckets.get(start, None)
+        if bucket is None:
+            bucket = self.buckets[start] = self.bucket_factory()
+            heapq.heappush(self.starts, start)
+        bucket.append(key)
+        self.length += 1
+
+    def pop(self, before, limit=None):
+        """
+        Return (up to limit) keys of events older than before.
+        """
+        out = []
+        while self.starts and self.starts[0] + self.granularity <= before:
+            bucket = self.buckets[self.starts[0]]
+            if limit is not None and len(out) + len(bucket) > limit:
+                take = limit - len(out)
+                if take > 0:
+                    out.extend(bucket[-take:])
+                    del bucket[-take:]
+                break
+            out.extend(bucket)
+            del self.buckets[heapq.heappop(self.starts)]
+        self.length -= len(out)
+        return out
+
+class DictEvents(dict):
+    def __init__(self):
+        dict.__init__(self)
+        self.wheel = ExpiryWheel()
+
+    def __setitem__(self, uri, value):
+        dict.__setitem__(self, uri, value)
+        self.wheel.add(value, uri)
+
+    def __reduce__(self):
+        return (self.__class__, (), None, None, iter(self.items()))
+
+    def update(self, other):
+        for uri, value in other.items():
+            self[uri] = value
+
+    def expire(self, before, limit=None):
+        count = 0
+        for uri in self.wheel.pop(before, limit):
+            if self.get(uri, before) < before:
+                del self[uri]
+                count += 1
+        return count
+
+DIGEST_SIZE = array('l').itemsize
+unpack_digest = struct.Struct('l').unpack
+class HashedEvents:
+    """
+    Events keyed by a fixed-width digest of the URI, with times kept in
+    whole seconds (rounded up). They're held in an open-addressed
+    (linear probing) hash table made of two packed arrays; a digest of
+    0 marks an empty slot.
+
+    A digest collision can only make a response stale early.
+    """
+    min_slots = 1024
+    max_load = 0.6
+
+    def __init__(self):
+        self.length = 0
+        self.wheel = ExpiryWheel(lambda: array('l'))
+        self._alloc(self.min_slots)
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, uri):
+        return self.digests[self._find(self._digest(uri))] != 0
+
+    def get(self, uri, default=None):
+        i = self._find(self._digest(uri))
+        if self.digests[i] == 0:
+            return default
+        return self.times[i]
+
+    def __getitem__(self, uri):
+        i = self._find(self._digest(uri))
+        if self.digests[i] == 0:
+            raise KeyError(uri)
+        return self.times[i]
+
+    def __setitem__(self, uri, value):
+        digest = self._digest(uri)
+        i = self._find(digest)
+        self.times[i] = int(math.ceil(value))
+        self.wheel.add(self.times[i], digest)
+        if self.digests[i] == 0:
+            self.digests[i] = digest
+            self.length += 1
+            if self.length > len(self.digests) * self.max_load:
+                self._resize(len(self.digests) * 2)
+
+    def __delitem__(self, uri):
+        i = self._find(self._digest(uri))
+        if self.digests[i] == 0:
+            raise KeyError(uri)
+        self._remove(i)
+
+    def update(self, other):
+        for uri, value in other.items():
+            self[uri] = value
+
+    def expire(self, before, limit=None):
+        count = 0
+        for digest in self.wheel.pop(before, limit):
+            i = self._find(digest)
+            if self.digests[i] != 0 and self.times[i] < before:
+                self._remove(i)
+                count += 1
+        slots = len(self.digests)
+        if slots > self.min_slots and self.length < slots * self.max_load / 4:
+            self._resize(slots // 2)
+        return count
+
+    def _digest(self, uri):
+        return unpack_digest(
+            hashlib.md5(_encode(uri)).digest()[:DIGEST_SIZE]
+        )[0] or 1
+
+    def _find(self, digest):
+        digests, mask = self.digests, self.mask
+        i = digest & mask
+        while True:
+            d = digests[i]
+            if d == digest or d == 0:
+                return i
+            i = (i + 1) & mask
+
+    def _remove(self, i):
+        # backward-shift deletion, so that no tombstones are needed
+        digests, times, mask = self.digests, self.times, self.mask
+        j = i
+        while True:
+            j = (j + 1) & mask
+            d = digests[j]
+            if d == 0:
+                break
+            home = d & mask
+            if (i < j and i < home <= j) or (i > j and (home > i or home <= j)):
+                continue
+            digests[i] = d
+            times[i] = times[j]
+            i = j
+        digests[i] = 0
+        times[i] = 0
+        self.length -= 1
+
+    def _alloc(self, slots):
+        self.mask = slots - 1
+        self.digests = array('l', [0]) * slots
+        self.times = array('l', [0]) * slots
+
+    def _resize(self, slots):
+        old_digests, old_times = self.digests, self.times
+        self._alloc(slots)
+        for i in xrange(len(old_digests)):
+            digest = old_digests[i]
+            if digest == 0:
+                continue
+            j = self._find(digest)
+            self.digests[j] = digest
+            self.times[j] = old_times[i]
+
+    def __getstate__(self):
+        return (
+            array_to_bytes(self.digests), array_to_bytes(self.times),
+            self.length
+        )
+
+    def __setstate__(self, state):
+        self.digests = array('l')
+        array_from_bytes(self.digests, state[0])
+        self.times = array('l')
+        array_from_bytes(self.times, state[1])
+        self.mask = len(self.digests) - 1
+        self.length = state[2]
+        self.wheel = ExpiryWheel(lambda: array('l'))
+        for i in xrange(len(self.digests)):
+            if self.digests[i] != 0:
+                self.wheel.add(self.times[i], self.digests[i])
+
+EVENT_STORES = {
+    'dict': DictEvents,
+    'hashed': HashedEvents,
+}
+
+class PathTrie:
+    """
+    Prefix events, in a trie of URI path segments; the newest event for a
+    prefix covering a URI is found in time proportional to the URI's
+    depth, however many prefixes there are.
+
+    A prefix covers URIs whose path segments (ignoring any query and
+    trailing slash) start with its own; e.g., http://example.com/news/
+    covers http://example.com/news and http://example.com/news/a?b=c, 
+    but not http://example.com/newsletter.
+    """
+    def __init__(self):
+        self.root = {}  # segment: node; a node's event time is at None
+        self.length = 0
+        self.wheel = ExpiryWheel()
+
+    def __len__(self):
+        return self.length
+
+    def __setitem__(self, uri, value):
+        node = self.root
+        for segment in self._segments(uri):
+            node = node.setdefault(segment, {})
+        if None not in node:
+            self.length += 1
+        node[None] = value
+        self.wheel.add(value, uri)
+
+    def __delitem__(self, uri):
+        path = []
+        node = self.root
+        for segment in self._segments(uri):
+            path.append((node, segment))
+            node = node.get(segment, None)
+            if node is None:
+                raise KeyError(uri)
+        if None not in node:
+            raise KeyError(uri)
+        del node[None]
+        self.length -= 1
+        for parent, segment in reversed(path):
+            if parent[segment]:
+                break
+            del parent[segment]
+
+    def __reduce__(self):
+        return (self.__class__, (), None, None, iter(self.items()))
+
+    def get(self, uri, default=None):
+        node = self.root
+        for segment in self._segments(uri):
+            node = node.get(segment, None)
+            if node is None:
+                return default
+        return node.get(None, default)
+
+    def match(self, uri):
+        """
+        Return the time of the newest event for a prefix covering uri, or
+        0 if there isn't one.
+        """
+        newest = 0
+        node = self.root
+        for segment in self._segments(uri):
+            node = node.get(segment, None)
+            if node is None:
+                break
+            when = node.get(None, 0)
+            if when > newest:
+                newest = when
+        return newest
+
+    def items(self):
+        out = []
+        stack = [([], self.root)]
+        while stack:
+            segments, node = stack.pop()
+            for segment, child in node.items():
+                if segment is None:
+                    out.append(("/".join(segments), child))
+                else:
+                    stack.append((segments + [segment], child))
+        return out
+
+    def update(self, other):
+        for uri, value in other.items():
+            self[uri] = value
+
+    def expire(self, before, limit=None):
+        count = 0
+        for uri in self.wheel.pop(before, limit):
+            if self.get(uri, before) < before:
+                del self[uri]
+                count += 1
+        return count
+
+    @staticmethod
+    def _segments(uri):
+        return uri.split('?', 1)[0].split('#', 1)[0].rstrip('/').split('/')
+
+
+## multi-child mode; one poller process shares state with lookup children
+
+EVENTS_MAGIC = b"CCE1"
+EVENTS_HEADER = struct.Struct("4sQ")
+
+class StatePublisher:
+    """
+    Publishes channel state into shared_dir for lookup children to map.
+
+    Each channel's events (which must be HashedEvents) are written to their 
+    own file when they change; an index of all channels, along with the
+    metadata needed to answer lookups (and any prefix events), is written
+    at most once a second.
+    Files are written to a temporary name and renamed into place.
+    """
+    index_delay = 1  # most seconds to wait before writing the index
+
+    def __init__(self, reactor_, manager, shared_dir):
+        self.reactor = reactor_
+        self.manager = manager
+        self.shared_dir = shared_dir
+        self.generations = {}  # channel_uri: events file generation
+        self.index_pending = False
+
+    def publish(self, channel):
+        changed = channel.pop('events_changed', False) or \
+            channel['uri'] not in self.generations
+        if changed and 'events' in channel:
+            self.generations[channel['uri']] = time.time()
+            self.write_events(channel)
+        self.publish_index()
+
+    def publish_index(self):
+        if not self.index_pending:
+            self.index_pending = True
+            self.reactor.callLater(self.index_delay, self.write_index)
+
+    def remove(self, channel_uri):
+        if self.generations.pop(channel_uri, None) is not None:
+            try:
+                os.remove(events_file(self.shared_dir, channel_uri))
+            except OSError as why:
+                logging.warning("events_remove_error <%s> (%s)",
+                    channel_uri, why
+                )
+        self.publish_index()
+
+    def write_events(self, channel):
+        events = channel['events']
+        self._write(events_file(self.shared_dir, channel['uri']), b"".join([
+            EVENTS_HEADER.pack(EVENTS_MAGIC, len(events)),
+            array_to_bytes(events.digests),
+            array_to_bytes(events.times)
+        ]))
+
+    def write_index(self):
+        self.index_pending = False
+        channels = {}
+        for channel_uri, channel in self.manager.channels.items():
+            entry = {'generation': self.generations.get(channel_uri, 0)}
+            for k in ['last_check', 'precision', 'lifetime',
+                      'events_refused']:
+                if k in channel:
+                    entry[k] = channel[k]
+            if channel.get('prefixes', None):
+                entry['prefixes'] = channel['prefixes'].items()
+            channels[channel_uri] = entry
+        self._write(os.path.join(self.shared_dir, "index"), pickle.dumps(
+            {'time': time.time(), 'channels': channels,
+             'refused': self.manager.refused},
+            pickle.HIGHEST_PROTOCOL
+        ))
+
+    def _write(self, path, data):
+        tmpfile = "%s.tmp" % path
+        try:
+            fh = open(tmpfile, 'wb')
+            try:
+                fh.write(data)
+            finally:
+                fh.close()
+            os.rename(tmpfile, path)
+        except (IOError, OSError) as why:
+            logging.critical("publish_error (%s)", why)
+
+def events_file(shared_dir, channel_uri):
+    return os.path.join(
+        shared_dir, "%s.events" % hashlib.md5(_encode(channel_uri)).hexdigest()
+    )
+
+class ControlProtocol(LineReceiver):
+    """
+    The poller's end of a connection from a lookup child, which sends
+    "subscribe <channel_uri>" and "want <channel_uri>" lines, and
+    "seen <channel_uri>" for channels it has had lookups for.
+    """
+    delimiter = b'\n'
+
+    def connectionMade(self):
+        self.factory.children += 1
+
+    def connectionLost(self, reason):
+        self.factory.children -= 1
+        if self.factory.children == 0:
+            self.factory.manager.reactor.callLater(
+                self.factory.idle_exit, self.factory.check_idle
+            )
+
+    def lineReceived(self, line):
+        line = _native(line)
+        try:
+            command, channel_uri = line.strip().split(None, 1)
+        except ValueError:
+            logging.warning("control_malformed_line %s", line)
+            return
+        if command == "subscribe":
+            self.factory.manager.add_channel(channel_uri)
+        elif command == "want":
+            self.factory.manager.add_channel(channel_uri)
+            self.factory.manager.want_channel(channel_uri)
+        elif command == "seen":
+            channel = self.factory.manager.channels.get(channel_uri, None)
+            if channel is not None:
+                channel['last_lookup'] = time.time()
+        else:
+            logging.warning("control_unknown_command %s", command)
+
+class ControlFactory(protocol.Factory):
+    protocol = ControlProtocol
+    idle_exit = 300  # seconds without children before the poller stops
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.children = 0
+
+    def check_idle(self):
+        if self.children == 0:
+            logging.info("poller_idle")
+            self.manager.reactor.stop()
+
+class _MappedArray:
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return unpack_digest_from(self.buf, self.offset + i * DIGEST_SIZE)[0]
+
+unpack_digest_from = struct.Struct('l').unpack_from
+class SharedEvents(HashedEvents):
+    """
+    Read-only HashedEvents, mapped from a file written by StatePublisher.
+    """
+    def __init__(self, path):
+        fh = open(path, 'rb')
+        try:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fh.close()
+        magic, self.length = EVENTS_HEADER.unpack_from(self.mm, 0)
+        if magic != EVENTS_MAGIC:
+            self.mm.close()
+            raise IOError("%s isn't an events file" % path)
+        slots = (len(self.mm) - EVENTS_HEADER.size) // (DIGEST_SIZE * 2)
+        self.mask = slots - 1
+        self.digests = _MappedArray(self.mm, EVENTS_HEADER.size, slots)
+        self.times = _MappedArray(
+            self.mm, EVENTS_HEADER.size + slots * DIGEST_SIZE, slots
+        )
+
+    def close(self):
+        self.mm.close()
+
+class SharedChannelMirror:
+    """
+    Stands in for ChannelManager in lookup children; channels are read from
+    the poller's shared state, and subscriptions are sent to it.
+    """
+    refresh_period = 1  # how often to look for a new index (seconds)
+    report_period = 60  # how often to tell the poller about lookups
+
+    def __init__(self, reactor_, config, configfile):
+        self.reactor = reactor_
+        self.config = config
+        self.configfile = configfile
+        self.shared_dir = config.get("main", "shared_dir")
+        self.extend_pct = config.getint("main", "extend_pct")
+        self.channels = {}
+        self.generations = {}  # channel_uri: generation of mapped events
+        self.index_stat = None
+        self.requested = {}  # (command, channel_uri): True, once sent
+        self.refused = {}  # channel_uri: why the poller won't add it
+        self.metrics = Metrics()  # not served; see metrics_address
+        self.control = MirrorControlFactory(self)
+
+    def start(self):
+        logging.info("start_mirror")
+        self.refresh()
+        self.reactor.callLater(self.report_period, self.report_lookups)
+        self.reactor.connectUNIX(
+            os.path.join(self.shared_dir, "control.sock"), self.control
+        )
+        self.reactor.run()
+
+    def shutdown(self):
+        logging.info("stop_mirror")
+        self.control.stopTrying()
+        self.reactor.stop()
+
+    def add_channel(self, channel_uri):
+        refused = self.refused.get(channel_uri, None)
+        if refused is None:
+            self.send("subscribe", channel_uri)
+        return refused
+
+    def want_channel(self, channel_uri):
+        self.send("want", channel_uri)
+
+    def send(self, command, channel_uri):
+        if (command, channel_uri) in self.requested:
+            return
+        self.requested[(command, channel_uri)] = True
+        if self.control.connection is not None:
+            self.control.connection.sendLine(
+                _encode("%s %s" % (command, channel_uri))
+            )
+
+    def connected(self):
+        for command, channel_uri in self.requested.keys():
+            self.control.connection.sendLine(
+                _encode("%s %s" % (command, channel_uri))
+            )
+
+    def report_lookups(self):
+        self.reactor.callLater(self.report_period, self.report_lookups)
+        if self.control.connection is None:
+            return
+        for channel_uri, channel in self.channels.items():
+            if channel.pop('last_lookup', None) is not None:
+                self.control.connection.sendLine(
+                    _encode("seen %s" % channel_uri)
+                )
+
+    def refresh(self):
+        self.reactor.callLater(self.refresh_period, self.refresh)
+        path = os.path.join(self.shared_dir, "index")
+        try:
+            st = os.stat(path)
+            index_stat = (st.st_ino, st.st_mtime, st.st_size)
+            if index_stat == self.index_stat:
+                return
+            fh = open(path, 'rb')
+            try:
+                index = pickle.load(fh)
+            finally:
+                fh.close()
+        except (IOError, OSError, EOFError, ValueError, 
+                pickle.UnpicklingError) as why:
+            logging.debug("index_read_error (%s)", why)
+            return
+        self.index_stat = index_stat
+        channels = {}
+        for channel_uri, entry in index['channels'].items():
+            old = self.channels.get(channel_uri, {})
+            old_events = old.pop('events', None)
+            channel = {'uri': channel_uri}
+            channel.update(entry)
+            if 'last_lookup' in old:
+                channel['last_lookup'] = old['last_lookup']
+            if 'prefixes' in entry:
+                channel['prefixes'] = PathTrie()
+                channel['prefixes'].update(dict(entry['prefixes']))
+            if not entry['generation']:
+                pass # nothing published yet
+            elif old_events is not None and \
+            entry['generation'] == self.generations.get(channel_uri, None):
+                channel['events'] = old_events
+                old_events = None
+            else:
+                self._map_events(channel)
+            if old_events is not None:
+                old_events.close()
+            if 'last_check' in channel:
+                set_verdict(channel, self.extend_pct)
+            channels[channel_uri] = channel
+        for channel_uri, channel in self.channels.items():
+            if channel_uri not in channels and 'events' in channel:
+                channel['events'].close()
+        self.channels = channels
+        self.refused = index.get('refused', {})
+        self.requested = {}
+
+    def _map_events(self, channel):
+        try:
+            channel['events'] = SharedEvents(
+                events_file(self.shared_dir, channel['uri'])
+            )
+            self.generations[channel['uri']] = channel['generation']
+        except (IOError, OSError, mmap.error, struct.error) as why:
+            logging.warning("events_map_error <%s> (%s)",
+                channel['uri'], why
+            )
+            if 'last_check' in channel:
+                del channel['last_check'] # don't answer without events
+
+    def spawn_poller(self):
+        logging.info("spawn_poller")
+        devnull = open(os.devnull, 'r+')
+        try:
+            subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), 
+                 "--poller", self.configfile],
+                stdin=devnull, stdout=devnull, stderr=devnull,
+                close_fds=True, preexec_fn=os.setsid
+            )
+        finally:
+            devnull.close()
+
+class MirrorControlProtocol(LineReceiver):
+    delimiter = b'\n'
+
+    def connectionMade(self):
+        self.factory.resetDelay()
+        self.factory.connection = self
+        self.factory.mirror.connected()
+
+class MirrorControlFactory(protocol.ReconnectingClientFactory):
+    protocol = MirrorControlProtocol
+    initialDelay = 0.5
+    maxDelay = 5
+
+    def __init__(self, mirror):
+        self.mirror = mirror
+        self.connection = None
+        self.spawned = False
+
+    def clientConnectionLost(self, connector, reason):
+        self.connection = None
+        protocol.ReconnectingClientFactory.clientConnectionLost(
+            self, connector, reason
+        )
+
+    def clientConnectionFailed(self, connector, reason):
+        self.connection = None
+        if not self.spawned:
+            self.spawned = True
+            self.mirror.spawn_poller()
+        protocol.ReconnectingClientFactory.clientConnectionFailed(
+            self, connector, reason
         )
-        date = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(now))
-        return "%s FRESH freshness=%s res{Date}=\"%s\" log=extended_%2.2f" % \
-            (req_id, extend_by, date, extend_by)
 
 
 def _unquotestring(instr):
@@ -369,13 +1828,6 @@ def _unquotestring(instr):
         instr = re.sub(r'\\(.)', r'\1', instr)
     return instr
 
-def _splitstring(instr, item, split):
-    if not instr: 
-        return []
-    return [ h.strip() for h in 
-             re.findall(r'%s(?=%s|\s*$)' % (item, split), instr)
-           ]    
-    
 ## Cache-Control header parsing
 TOKEN = r'(?:[^\(\)<>@,;:\\"/\[\]\?={} \t]+?)'
 QUOTED_STRING = r'(?:"(?:\\"|[^"])*")'
@@ -396,7 +1848,7 @@ def parse_cc(instr, force_list=None):
             value = True
         attr = attr.lower()
         if force_list and attr in force_list:
-            if out.has_key(attr):
+            if attr in out:
                 out[attr].append(value)
             else:
                 out[attr] = [value]
@@ -407,6 +1859,8 @@ def parse_cc(instr, force_list=None):
 LINK = r'<[^>]*>\s*(?:;\s*%(PARAMETER)s?\s*)*' % locals()
 LINK_SPLIT = r'%s(?=%s|\s*$)' % (LINK, COMMA)
 link_splitter = re.compile(LINK_SPLIT)
+LINK_PARAM_SPLIT = r'%s(?=\s*;\s*|\s*$)' % PARAMETER
+link_param_splitter = re.compile(LINK_PARAM_SPLIT)
 def parse_link(instr):
     out = {}
     if not instr: 
@@ -415,7 +1869,7 @@ def parse_link(instr):
         url, params = link.split(">", 1)
         url = url[1:]
         param_dict = {}
-        for param in _splitstring(params, PARAMETER, "\s*;\s*"):
+        for param in [h.strip() for h in link_param_splitter.findall(params)]:
             try:
                 a, v = param.split("=", 1)
                 param_dict[a.lower()] = _unquotestring(v)
@@ -424,30 +1878,676 @@ def parse_link(instr):
         out[url] = param_dict
     return out
 
+## resolved, cached header values
+
+def resolve_headers(request_uri, cc_str, link_str):
+    """
+    Parse the (quoted) Cache-Control and Link headers of a response to
+    request_uri, returning ((channel_maxage, channel_uri, group_uris),
+    cacheable). channel_uri and the invalidating group_uris are absolute.
+    If cacheable is False, the result depends on more than request_uri's
+    directory.
+    """
+    cc = parse_cc(unquote(cc_str))
+    links = parse_link(unquote(link_str))
+    refs = []
+    channel_uri = cc.get('channel', None)
+    if channel_uri is True:
+        channel_uri = None
+    if channel_uri is not None:
+        refs.append(channel_uri)
+        channel_uri = urljoin(request_uri, channel_uri)
+    group_uris = []
+    for group_uri, params in links.items():
+        if (params.get('rev', None) or "").lower() != 'invalidates':
+            continue
+        refs.append(group_uri)
+        group_uris.append(urljoin(request_uri, group_uri))
+    cacheable = True
+    for ref in refs:
+        if ref[:1] in ["", "?", "#", ";"]:
+            cacheable = False
+    headers = (cc.get('channel-maxage', None), channel_uri, group_uris)
+    return headers, cacheable
+
+class LRUCache:
+    """
+    A mapping of at most size items; when full, the least recently used
+    one is discarded. Counts hits and misses.
+    """
+    KEY, VALUE, PREV, NEXT = 0, 1, 2, 3
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.data = {}  # key: [key, value, prev_link, next_link]
+        self.root = []
+        self.root[:] = [None, None, self.root, self.root]
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        link = self.data.get(key, None)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._unlink(link)
+        self._push(link)
+        return link[self.VALUE]
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        link = self.data.get(key, None)
+        if link is not None:
+            self._unlink(link)
+        elif len(self.data) >= self.size:
+            oldest = self.root[self.PREV]
+            self._unlink(oldest)
+            del self.data[oldest[self.KEY]]
+        link = [key, value, None, None]
+        self.data[key] = link
+        self._push(link)
+
+    def _unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+
+    def _push(self, link):
+        first = self.root[self.NEXT]
+        link[self.PREV] = self.root
+        link[self.NEXT] = first
+        first[self.PREV] = link
+        self.root[self.NEXT] = link
+
+class QueueLogHandler(logging.Handler):
+    """
+    Passes log records to a thread that formats and writes them with 
+    target (e.g., a RotatingFileHandler, which rotates there too), so that
+    logging doesn't block the event loop.
+
+    No more than size records wait; others are dropped and counted, and 
+    the count is logged when there's room again.
+    """
+    def __init__(self, target, size):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = queue.Queue(size)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name="log_writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        reported = 0
+        while True:
+            record = self.queue.get()
+            dropped = self.dropped
+            if dropped != reported:
+                self.target.handle(logging.makeLogRecord({
+                    'levelno': logging.WARNING, 'levelname': "WARNING",
+                    'msg': "log_dropped %i", 'args': (dropped - reported,)
+                }))
+                reported = dropped
+            if record is None:
+                break
+            self.target.handle(record)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.target.close()
+        logging.Handler.close(self)
+
+## metrics
+
+class Histogram:
+    """
+    Counts observations into buckets with the given upper bounds.
+    """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last is for +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """
+    Counters and histograms for lookups and channel checks, rendered
+    along with per-channel stats in the Prometheus text format.
+    """
+    prefix = "squid_channels_"
+    lookup_bounds = [
+        .00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .01
+    ]
+    check_bounds = [.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60]
+
+    def __init__(self):
+        self.verdicts = {}  # log= reason: count
+        self.lookup_seconds = Histogram(self.lookup_bounds)
+        self.check_seconds = Histogram(self.check_bounds)
+        self.check_errors = 0
+        self.pushed_events = 0
+        self.evicted_channels = 0
+        self.refused_events = 0
+        self.header_cache = None  # the handler's LRUCache
+
+    def count_verdict(self, response):
+        reason = response[response.rfind("log=") + 4:]
+        if reason.startswith("extended_"):
+            reason = "extended"
+        self.verdicts[reason] = self.verdicts.get(reason, 0) + 1
+
+    def render(self, manager):
+        out = []
+        def metric(name, kind, help_text, samples):
+            name = self.prefix + name
+            out.append("# HELP %s %s" % (name, help_text))
+            out.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                out.append("%s%s %s" % (name, labels, value))
+        def histogram(name, help_text, h):
+            samples = []
+            total = 0
+            for bound, count in zip(h.bounds + ["+Inf"], h.counts):
+                total += count
+                samples.append(('_bucket{le="%s"}' % bound, total))
+            samples.append(("_sum", repr(h.sum)))
+            samples.append(("_count", h.count))
+            metric(name, "histogram", help_text, samples)
+        metric("verdicts_total", "counter", "Answers to Squid, by reason.", [
+            ('{verdict="%s"}' % _label(reason), count)
+            for reason, count in sorted(self.verdicts.items())
+        ])
+        histogram("lookup_seconds", "Time to work out an answer.",
+            self.lookup_seconds
+        )
+        if self.header_cache is not None:
+            metric("header_cache_total", "counter", "Parsed header lookups.", [
+                ('{result="hit"}', self.header_cache.hits),
+                ('{result="miss"}', self.header_cache.misses)
+            ])
+        histogram("check_seconds", "Time to check a channel.",
+            self.check_seconds
+        )
+        metric("check_errors_total", "counter", "Failed channel checks.", [
+            ("", self.check_errors)
+        ])
+        metric("pushed_events_total", "counter", 
+            "New stale events pushed by publishers.", [
+            ("", self.pushed_events)
+        ])
+        metric("refused_events_total", "counter", 
+            "New stale events not kept, because of max_events.", [
+            ("", self.refused_events)
+        ])
+        metric("evicted_channels_total", "counter", 
+            "Channels removed because Squid stopped asking about them.", [
+            ("", self.evicted_channels)
+        ])
+        fetcher = getattr(manager, 'fetcher', None)
+        if fetcher is not None:
+            metric("fetches", "gauge", "Fetches in progress or waiting.", [
+                ('{state="active"}', fetcher.active),
+                ('{state="waiting"}', sum(
+                    [len(w) for w in fetcher.waiting.values()]
+                ))
+            ])
+        now = time.time()
+        channels = sorted(manager.channels.items())
+        metric("channels", "gauge", "Channels being monitored.", [
+            ("", len(channels))
+        ])
+        for name, kind, help_text, get in [
+            ("channel_events", "gauge", "Stale events held.",
+             lambda c: len(c.get('events', ()))),
+            ("channel_fetched_bytes_total", "counter", "Bytes fetched.",
+             lambda c: c.get('fetched_bytes', None)),
+            ("channel_archive_depth", "gauge", 
+             "Archive documents read by the last check.",
+             lambda c: c.get('archive_depth', None)),
+            ("channel_last_check_age_seconds", "gauge",
+             "Seconds since the last successful check.",
+             lambda c: 'last_check' in c and \
+                "%.3f" % (now - c['last_check']) or None),
+            ("channel_failures", "gauge", "Check failures in a row.",
+             lambda c: c.get('failures', 0)),
+        ]:
+            samples = []
+            for channel_uri, channel in channels:
+                value = get(channel)
+                if value is not None:
+                    samples.append(
+                        ('{channel="%s"}' % _label(channel_uri), value)
+                    )
+            metric(name, kind, help_text, samples)
+        return "\n".join(out) + "\n"
+
+    def http_response(self, manager):
+        body = _encode(self.render(manager))
+        return b"".join([
+            b"HTTP/1.0 200 OK\r\n",
+            b"Content-Type: text/plain; version=0.0.4\r\n",
+            b"Content-Length: ", _encode(str(len(body))), b"\r\n\r\n",
+            body
+        ])
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n"
+    )
+
+class MetricsProtocol(LineReceiver):
+    """
+    Answers any HTTP request with the metrics.
+    """
+    def lineReceived(self, line):
+        if not line.strip():
+            self.transport.write(self.factory.manager.metrics.http_response(
+                self.factory.manager
+            ))
+            self.transport.loseConnection()
+
+class MetricsFactory(protocol.Factory):
+    protocol = MetricsProtocol
+
+    def __init__(self, manager):
+        self.manager = manager
+
+def listen_metrics(reactor_, manager, address):
+    """
+    Serve metrics on address; a path for a Unix socket, or host:port.
+    """
+    listen(reactor_, MetricsFactory(manager), address)
+
+def listen(reactor_, factory, address):
+    if "/" in address:
+        reactor_.listenUNIX(address, factory, wantPID=True)
+    else:
+        host, port = address.rsplit(":", 1)
+        reactor_.listenTCP(int(port), factory, interface=host)
+
+
+## pushed events
+
+class PushReceiver:
+    """
+    Takes stale events that a channel's publisher POSTs to 
+    /events?channel=<channel URI>, as an Atom document like the channel's
+    own (relative links are against the channel URI), and applies them
+    if the channel is being monitored.
+    """
+    def __init__(self, manager):
+        self.manager = manager
+        self.max_size = manager.config.getint("main", "max_document_size")
+
+    def handle(self, request_line, headers, body):
+        """
+        Return the HTTP response to a request; headers maps lowercased
+        names to values.
+        """
+        try:
+            method, target = request_line.split()[:2]
+        except ValueError:
+            return self.response(400, "Bad request line")
+        if method != "POST":
+            return self.response(405, "Use POST")
+        path, _, query = target.partition("?")
+        channel_uri = None
+        for param in query.split("&"):
+            name, _, value = param.partition("=")
+            if name == "channel":
+                channel_uri = unquote(value.replace("+", " "))
+        if path != "/events" or not channel_uri:
+            return self.response(404, "POST to /events?channel=<uri>")
+        try:
+            head_links, md, events, prefix_events = parse_feed(
+                channel_uri, body, None, headers.get('content-encoding'),
+                self.max_size
+            )
+        except (expat.ExpatError, DecodeError, NotImplementedError,
+                ValueError, OverflowError) as why:
+            return self.response(400, "Can't parse events (%s)" % why)
+        added = self.manager.push_events(channel_uri, events, prefix_events)
+        if added is None:
+            return self.response(404, "Channel not monitored")
+        return self.response(200, "%i new events" % added)
+
+    def response(self, status, text):
+        body = _encode("%s\n" % text)
+        return b"".join([
+            _encode("HTTP/1.0 %i %s\r\n" % (status, text.split(" (")[0])),
+            b"Content-Type: text/plain\r\n",
+            b"Content-Length: ", _encode(str(len(body))), b"\r\n\r\n",
+            body
+        ])
+
+class PushProtocol(LineReceiver):
+    """
+    Reads an HTTP request (with a Content-Length body) for a PushReceiver.
+    """
+    def connectionMade(self):
+        self.receiver = self.factory.receiver
+        self.request_line = None
+        self.headers = {}
+        self.body = []
+        self.length = 0
+        self.received = 0
+
+    def lineReceived(self, line):
+        line = _native(line)
+        if self.request_line is None:
+            self.request_line = line
+        elif line.strip():
+            name, _, value = line.partition(":")
+            self.headers[name.strip().lower()] = value.strip()
+        elif 'transfer-encoding' in self.headers:
+            self.finish(self.receiver.response(411, "Content-Length needed"))
+        else:
+            try:
+                self.length = int(self.headers.get('content-length', 0))
+            except ValueError:
+                self.length = -1
+            if not 0 <= self.length <= self.receiver.max_size:
+                self.finish(self.receiver.response(413, "Too large"))
+            elif self.length == 0:
+                self.respond()
+            else:
+                self.setRawMode()
+
+    def rawDataReceived(self, data):
+        self.body.append(data)
+        self.received += len(data)
+        if self.received >= self.length:
+            self.setLineMode()
+            self.respond()
+
+    def respond(self):
+        body = b"".join(self.body)[:self.length]
+        self.finish(
+            self.receiver.handle(self.request_line, self.headers, body)
+        )
+
+    def finish(self, response):
+        self.transport.write(response)
+        self.transport.loseConnection()
+
+class PushFactory(protocol.Factory):
+    protocol = PushProtocol
+
+    def __init__(self, manager):
+        self.receiver = PushReceiver(manager)
+
+def listen_push(reactor_, manager, address):
+    """
+    Take pushed events on address; a path for a Unix socket, or host:port.
+    """
+    listen(reactor_, PushFactory(manager), address)
+
+## profiling the running process
+
+class Profiler:
+    """
+    Profiles the process for profile_seconds when asked to (see
+    profile_on_signal), and writes a report next to the log file; until
+    then, nothing is hooked in.
+
+    A "cpu" session uses cProfile; a "memory" session uses tracemalloc
+    (Python 3 only) to find the largest allocators, and what grew during
+    the session. Both report event loop lag and garbage collection pauses.
+    """
+    lag_interval = 0.1  # how often to measure event loop lag (seconds)
+    top = 30  # how many functions or allocators to list
+
+    def __init__(self, reactor_, logfile, seconds):
+        self.reactor = reactor_
+        self.logfile = logfile
+        self.seconds = seconds
+        self.kind = None  # of the session in progress
+        self.started = None
+        self.calls = []  # pending DelayedCalls for the session
+        self.profile = None  # cProfile.Profile, for cpu sessions
+        self.snapshot = None  # tracemalloc snapshot, for memory sessions
+        self.traced = False  # whether we started tracemalloc
+        self.lags = []  # seconds late for each lag_interval
+        self.gc_pauses = {}  # generation: [seconds, ...]
+        self.gc_start = None
+
+    def toggle(self, kind):
+        """
+        Start a session of kind, or end the one in progress early.
+        """
+        if self.kind is None:
+            self.start(kind)
+        else:
+            self.stop()
+
+    def start(self, kind):
+        if kind == "memory" and tracemalloc is None:
+            logging.warning("profile_unavailable %s (needs Python 3)", kind)
+            return
+        logging.info("profile_start %s %i", kind, self.seconds)
+        self.kind = kind
+        self.started = time.time()
+        self.lags = []
+        self.gc_pauses = {}
+        if hasattr(gc, 'callbacks'):
+            gc.callbacks.append(self._gc_phase)
+        if kind == "memory":
+            self.traced = not tracemalloc.is_tracing()
+            if self.traced:
+                tracemalloc.start()
+            self.snapshot = tracemalloc.take_snapshot()
+        self.calls = [
+            self.reactor.callLater(self.seconds, self._expire),
+            self.reactor.callLater(self.lag_interval, self._tick,
+                self.started + self.lag_interval
+            )
+        ]
+        if kind == "cpu":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self):
+        if self.kind is None:
+            return
+        if self.profile is not None:
+            self.profile.disable()
+        elapsed = time.time() - self.started
+        for call in self.calls:
+            call.cancel()
+        self.calls = []
+        if hasattr(gc, 'callbacks'):
+            gc.callbacks.remove(self._gc_phase)
+        out = ["%s profile of PID %i for %.1f seconds from %s" % (
+            self.kind, os.getpid(), elapsed,
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started))
+        )]
+        self._report_lag(out)
+        self._report_gc(out)
+        if self.profile is not None:
+            self._report_profile(out)
+        if self.snapshot is not None:
+            self._report_memory(out)
+        self.kind = self.profile = self.snapshot = None
+        path = "%s.profile-%i-%s" % (self.logfile, os.getpid(),
+            time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+        )
+        try:
+            fh = open(path, 'w')
+            try:
+                fh.write("\n".join(out) + "\n")
+            finally:
+                fh.close()
+        except IOError as why:
+            logging.warning("profile_write_error (%s)", why)
+            return
+        logging.info("profile_written <%s>", path)
+
+    def _expire(self):
+        self.calls.pop(0)
+        self.stop()
+
+    def _tick(self, expected):
+        now = time.time()
+        self.lags.append(max(now - expected, 0))
+        self.calls[-1] = self.reactor.callLater(
+            self.lag_interval, self._tick, now + self.lag_interval
+        )
+
+    def _gc_phase(self, phase, info):
+        if phase == "start":
+            self.gc_start = time.time()
+        elif self.gc_start is not None:
+            self.gc_pauses.setdefault(info['generation'], []).append(
+                time.time() - self.gc_start
+            )
+            self.gc_start = None
+
+    def _report_lag(self, out):
+        lags = sorted(self.lags)
+        out.append("\n== Event loop lag (ms, checked every %i ms)" % (
+            self.lag_interval * 1000
+        ))
+        if not lags:
+            out.append("no samples")
+            return
+        out.append("samples %i  mean %.2f  p50 %.2f  p99 %.2f  max %.2f" % (
+            len(lags), sum(lags) / len(lags) * 1000,
+            lags[len(lags) // 2] * 1000,
+            lags[min(len(lags) - 1, int(len(lags) * .99))] * 1000,
+            lags[-1] * 1000
+        ))
+
+    def _report_gc(self, out):
+        out.append("\n== Garbage collection pauses")
+        if not hasattr(gc, 'callbacks'):
+            out.append("not available (needs Python 3)")
+            return
+        if not self.gc_pauses:
+            out.append("none")
+        for generation, pauses in sorted(self.gc_pauses.items()):
+            out.append(
+                "generation %i: %i collections, %.2f ms total, %.2f ms max" % (
+                generation, len(pauses), sum(pauses) * 1000, 
+                max(pauses) * 1000
+            ))
+
+    def _report_profile(self, out):
+        for sort, title in [
+            ("tottime", "Functions by own time"),
+            ("cumulative", "Functions by cumulative time")
+        ]:
+            buf = StringIO()
+            stats = pstats.Stats(self.profile, stream=buf)
+            stats.sort_stats(sort).print_stats(self.top)
+            out.append("\n== %s (cProfile)" % title)
+            out.append(buf.getvalue().strip())
+
+    def _report_memory(self, out):
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__)
+        ])
+        if self.traced:
+            tracemalloc.stop()
+        out.append("\n== Largest allocators (live at the end)")
+        for stat in snapshot.statistics('lineno')[:self.top]:
+            out.append(str(stat))
+        out.append("\n== Allocation growth during the session")
+        for stat in snapshot.compare_to(self.snapshot, 'lineno')[:self.top]:
+            out.append(str(stat))
+
+def profile_on_signal(reactor_, profiler):
+    """
+    SIGUSR1 starts a cpu profile, and SIGUSR2 a memory one; either ends a
+    profile in progress early.
+    """
+    for signum, kind in [(signal.SIGUSR1, "cpu"), (signal.SIGUSR2, "memory")]:
+        signal.signal(signum, lambda signum, frame, kind=kind:
+            reactor_.callFromThread(profiler.toggle, kind)
+        )
+
+CONFIG_DEFAULTS = {
+    'pidfile': None,
+    'http_proxy': None,
+    'extend_pct': "33",
+    'log_level': "INFO",
+    'fetch_timeout': "10",
+    'log_backup': "5",
+    'early_stop': "false",
+    'statefile': None,
+    'state_period': "300",
+    'max_host_connections': "6",
+    'idle_timeout': "60",
+    'header_cache_size': "1000",
+    'event_store': "dict",
+    'poll_jitter': "10",
+    'max_fetches': "10",
+    'archive_prefetch': "4",
+    'shared_dir': None,
+    'engine': "twisted",
+    'log_queue': "0",
+    'metrics_address': None,
+    'dns_ttl': "300",
+    'dns_negative_ttl': "30",
+    'compression': "true",
+    'max_document_size': "67108864",
+    'push_address': None,
+    'channel_idle_timeout': "604800",
+    'max_channels': "1000",
+    'max_events': "10000000",
+    'profile_seconds': "60",
+}
+
 def error(msg):
     logging.critical(msg)
     sys.stderr.write("FATAL: %s\n" % msg)
     sys.exit(1)
 
-def main(configfile):        
+def main(configfile, poller=False):        
     # load config
     try:
-        config = ConfigParser.SafeConfigParser(
-           {
-            'pidfile': None, 
-            'http_proxy': None, 
-            'extend_pct': "33", 
-            'log_level': logging.INFO, 
-            'fetch_timeout': "10",
-            'log_backup': "5",
-            }
-        )
+        config = ConfigParser(CONFIG_DEFAULTS, allow_no_value=True)
         config.read(configfile)
         pidfile = config.get("main", "pidfile")
         logfile = config.get("main", "logfile")
         log_level = config.get("main", "log_level").strip().upper()
-        log_backup = config.getint("main", "log_backup")        
-    except ConfigParser.Error, why:
+        log_backup = config.getint("main", "log_backup")
+        log_queue = config.getint("main", "log_queue")        
+        if config.get("main", "event_store") not in EVENT_STORES:
+            error("Configuration file: unknown event_store %s" % \
+                config.get("main", "event_store")
+            )
+        shared_dir = config.get("main", "shared_dir")
+        engine = config.get("main", "engine")
+        if engine not in ["twisted", "asyncio"]:
+            error("Configuration file: unknown engine %s" % engine)
+        if engine == "asyncio" and sys.version_info < (3, 7):
+            error("Configuration file: engine asyncio needs Python 3.7+")
+        if engine == "asyncio" and (shared_dir or poller):
+            error("Configuration file: engine asyncio can't use shared_dir")
+        if poller and not shared_dir:
+            error("Configuration file: --poller needs shared_dir")
+        if poller:
+            config.set("main", "event_store", "hashed")
+        elif shared_dir:
+            pidfile = None # lookup children don't own the PID file
+    except configparser.Error as why:
         error("Configuration file: %s\n" % why)
             
     # logging
@@ -456,12 +2556,17 @@ def main(configfile):
         hdlr = RotatingFileHandler(
             logfile, maxBytes=1024 * 1024 * 10, backupCount=log_backup
         )
-    except IOError, why:
+    except IOError as why:
         error("Can't open log file (%s)" % why)
     formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
     hdlr.setFormatter(formatter)
+    if log_queue > 0:
+        hdlr = QueueLogHandler(hdlr, log_queue)
     logger.addHandler(hdlr) 
-    logger.setLevel(logging._levelNames.get(log_level, logging.INFO))
+    level = logging.getLevelName(log_level)
+    if not isinstance(level, int):
+        level = logging.INFO
+    logger.setLevel(level)
 
     # PID management
     if pidfile:
@@ -473,24 +2578,70 @@ def main(configfile):
             pid_fh = open(pidfile, 'w')
             pid_fh.write(str(os.getpid()))
             pid_fh.close()
-        except IOError, why:
+        except IOError as why:
             error("Can't write PID file (%s)." % why)
     
     # run
     try:
         try:
-            cm = ChannelManager(reactor, config)
-            stdio.StandardIO(SquidHandlerProtocol(cm))
+            if poller:
+                cm = ChannelManager(reactor, config)
+                cm.publisher = StatePublisher(reactor, cm, shared_dir)
+                reactor.listenUNIX(
+                    os.path.join(shared_dir, "control.sock"),
+                    ControlFactory(cm), wantPID=True
+                )
+                reactor.addSystemEventTrigger('before', 'shutdown', cm.save)
+            elif shared_dir:
+                cm = SharedChannelMirror(reactor, config, configfile)
+                stdio.StandardIO(SquidHandlerProtocol(cm))
+            elif engine == "asyncio":
+                import aio_engine
+                cm = aio_engine.setup(config)
+            else:
+                cm = ChannelManager(reactor, config)
+                stdio.StandardIO(SquidHandlerProtocol(cm))
+            metrics_address = config.get("main", "metrics_address")
+            if metrics_address and (poller or not shared_dir):
+                try:
+                    if engine == "asyncio":
+                        aio_engine.listen_metrics(cm, metrics_address)
+                    else:
+                        listen_metrics(reactor, cm, metrics_address)
+                except (internet_error.CannotListenError, OSError) as why:
+                    error("Can't serve metrics on %s (%s)." % (
+                        metrics_address, why
+                    ))
+            push_address = config.get("main", "push_address")
+            if push_address and (poller or not shared_dir):
+                try:
+                    if engine == "asyncio":
+                        aio_engine.listen_push(cm, push_address)
+                    else:
+                        listen_push(reactor, cm, push_address)
+                except (internet_error.CannotListenError, OSError) as why:
+                    error("Can't take pushed events on %s (%s)." % (
+                        push_address, why
+                    ))
+            profiler = Profiler(cm.reactor, logfile,
+                config.getint("main", "profile_seconds")
+            )
+            if engine == "asyncio":
+                aio_engine.profile_on_signal(cm, profiler)
+            else:
+                profile_on_signal(reactor, profiler)
             cm.start()
-        except IOError, why:
+        except internet_error.CannotListenError as why:
+            error("Poller already running (%s)." % why)
+        except IOError as why:
             error(why)
-        except ConfigParser.Error, why:
+        except configparser.Error as why:
             error("Configuration file: %s\n" % why)
     finally:
         if pidfile:
             try:
                 os.unlink(pidfile)
-            except OSError, why:
+            except OSError as why:
                 error("Can't remove PID file (%s)." % why)
 
 
@@ -502,89 +2653,621 @@ ATOM = "http://www.w3.org/2005/Atom"
 RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
 CC = "http://purl.org/syndication/cache-channel"
 
-# TODO: move from DOM to SAX.
 # TODO: work with more events than just cc:stale
 
-def parse_feed(uri, instr):
-    def get_links(base_uri, node):
-        if not node: 
-            return {}
-        return dict([
-            (i.getAttribute("rel") or "alternate", 
-             urljoin(base_uri, i.getAttribute("href"))
-            ) for i in node if (
-             i.namespaceURI == ATOM and i.localName == "link" 
-            )
-        ])
-    dom = xml.dom.minidom.parseString(instr)
-    if dom.documentElement.namespaceURI != ATOM or \
-    dom.documentElement.localName != u'feed':
-        raise NotImplementedError, "Feed Format Not Recognized"
-        
-    head = [i for i in dom.documentElement.childNodes if not (i.namespaceURI != ATOM and i.localName == "entry")]
-    entries = [i for i in dom.documentElement.childNodes if (i.namespaceURI == ATOM and i.localName == "entry")]
-    head_links = get_links(uri, head)
-    md = {
-      "precision": ([i.childNodes[0].data.strip() for i in head if i.namespaceURI == CC and i.localName == "precision"][:1] or [None])[0],
-      "lifetime": ([i.childNodes[0].data.strip() for i in head if i.namespaceURI == CC and i.localName == "lifetime"][:1] or [None])[0],
-      "archive_num": ([i.childNodes[0].data.strip() for i in head if i.namespaceURI == CC and i.localName == "archive_num"][:1] or [0])[0],
-    }
-    events = []
-    for entry in entries:
-        if entry.getElementsByTagNameNS(CC, 'stale') == []:
-            continue # only interested in stale events for now
-        entry_uri = get_links(uri, entry.childNodes)['alternate']
-        updated_str = entry.getElementsByTagNameNS(
-            ATOM, "updated")[0].firstChild.data.strip()
-        if updated_str:
-            updated = calendar.timegm(
-                parser.parse(updated_str).utctimetuple()
-            )   #IGNORE:E1103
+FEED_ELEMENT = "%s feed" % ATOM
+ENTRY_ELEMENT = "%s entry" % ATOM
+LINK_ELEMENT = "%s link" % ATOM
+UPDATED_ELEMENT = "%s updated" % ATOM
+STALE_ELEMENT = "%s stale" % CC
+MD_ELEMENTS = {
+    "%s precision" % CC: "precision",
+    "%s lifetime" % CC: "lifetime",
+    "%s archive_num" % CC: "archive_num",
+}
+
+class _StopParsing(Exception):
+    pass
+
+class FeedParser:
+    """
+    Streaming Atom channel parser. Call feed() with successive pieces of
+    the document and close() when it's done; close() returns
+    (head_links, md, events, prefix_events). Entries marked 
+    <cc:stale scope="prefix"/> are prefix events, which make everything 
+    under their URI stale (see PathTrie).
+
+    If since is set, parsing stops as soon as the entries are seen to be
+    in reverse-chronological order and older than it. Note that head
+    elements that appear after that point will be missed.
+    """
+    def __init__(self, uri, since=None):
+        self.uri = uri
+        self.since = since
+        self.head_links = {}
+        self.md = {"precision": None, "lifetime": None, "archive_num": 0}
+        self.events = []
+        self.prefix_events = []
+        self.stopped = False
+        self._md_seen = {}
+        self._depth = 0
+        self._text = None
+        self._entry = None
+        self._last_updated = None
+        self._in_order = True
+        self._parser = expat.ParserCreate(namespace_separator=" ")
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._chars
+
+    def feed(self, data):
+        if self.stopped:
+            return
+        try:
+            self._parser.Parse(data, False)
+        except _StopParsing:
+            self.stopped = True
+
+    def close(self):
+        if not self.stopped:
+            try:
+                self._parser.Parse(b"", True)
+            except _StopParsing:
+                self.stopped = True
+        self._parser = None
+        return self.head_links, self.md, self.events, self.prefix_events
+
+    def _start(self, name, attrs):
+        self._depth += 1
+        if self._depth == 1:
+            if name != FEED_ELEMENT:
+                raise NotImplementedError("Feed Format Not Recognized")
+        elif self._depth == 2:
+            if name == ENTRY_ELEMENT:
+                self._entry = {
+                    'links': {}, 'stale': False, 'prefix': False, 
+                    'updated': None
+                }
+            elif name == LINK_ELEMENT:
+                self._add_link(self.head_links, attrs)
+            elif name in MD_ELEMENTS and \
+            name not in self._md_seen:
+                self._text = []
+        elif self._entry is not None:
+            if name == STALE_ELEMENT:
+                self._entry['stale'] = True
+                self._entry['prefix'] = attrs.get("scope", None) == "prefix"
+            elif name == LINK_ELEMENT and self._depth == 3:
+                self._add_link(self._entry['links'], attrs)
+            elif name == UPDATED_ELEMENT and self._entry['updated'] is None:
+                self._text = []
+
+    def _chars(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+    def _end(self, name):
+        if self._depth == 2:
+            if name == ENTRY_ELEMENT:
+                entry, self._entry = self._entry, None
+                self._end_entry(entry)
+            elif name in MD_ELEMENTS and self._text is not None:
+                self._md_seen[name] = True
+                self.md[MD_ELEMENTS[name]] = "".join(self._text).strip()
+        elif name == UPDATED_ELEMENT and self._entry is not None and \
+        self._text is not None:
+            self._entry['updated'] = "".join(self._text).strip()
+        self._text = None
+        self._depth -= 1
+
+    def _add_link(self, links, attrs):
+        links[attrs.get("rel", "") or "alternate"] = \
+            urljoin(self.uri, attrs.get("href", ""))
+
+    def _end_entry(self, entry):
+        if not entry['stale']:
+            return # only interested in stale events for now
+        entry_uri = entry['links'].get('alternate', None)
+        if entry_uri is None:
+            return
+        updated = None
+        if entry['updated']:
+            try:
+                updated = parse_date(entry['updated'])
+            except (ValueError, OverflowError):
+                pass # treated as a bad_event_date
+        if entry['prefix']:
+            self.prefix_events.append((entry_uri, updated))
         else:
-            updated = None
-        events.append((entry_uri, updated))
-    return head_links, md, events
-
-
-## twisted getPage with proxy
-def getPage(url, contextFactory=None, proxy=None, *args, **kwargs):
-    scheme, host, port, path = client._parse(url)
-    if proxy:
-        host, port = proxy.split(':')
-        port = int(port)
-        kwargs['proxy'] = proxy
-    factory = HTTPClientFactory(url, *args, **kwargs)
-    reactor.connectTCP(host, port, factory)  #IGNORE:E1101
-    return factory.deferred
-
-class HTTPClientFactory(client.HTTPClientFactory):
-    def __init__(self, *args, **kwargs):
-        self.proxy = kwargs.get('proxy', None)
-        if self.proxy != None:            
-            del kwargs['proxy']
-        client.HTTPClientFactory.__init__(self, *args, **kwargs)
-        
-    def setURL(self, url):
-        self.url = url
-        scheme, host, port, path = client._parse(url)
-        if scheme and host:
-            self.scheme = scheme
-            self.host = host
-            self.port = port
-        if self.proxy:
-            self.path = "%s://%s:%s%s" % (self.scheme,  
-                                          self.host,  
-                                          self.port,  
-                                          path)
+            self.events.append((entry_uri, updated))
+        if self.since is None or updated is None:
+            return
+        if self._last_updated is not None:
+            if updated > self._last_updated:
+                self._in_order = False
+            elif self._in_order and updated < self.since:
+                raise _StopParsing
+        self._last_updated = updated
+
+def parse_feed(uri, instr, since=None, coding=None, max_size=None):
+    """
+    Parse a channel document. If coding (its Content-Encoding) is given,
+    it's decompressed a piece at a time, and each piece is parsed before
+    the next is decompressed.
+    """
+    p = FeedParser(uri, since)
+    for chunk in decode(instr, coding, max_size):
+        p.feed(chunk)
+        if p.stopped:
+            break
+    return p.close()
+
+class DecodeError(Exception):
+    pass
+
+def decode(data, coding, max_size=None, chunk_size=65536):
+    """
+    Yield data decoded from the given Content-Encoding, in pieces of no
+    more than chunk_size bytes; raises DecodeError if it can't be decoded,
+    or if it decodes to more than max_size bytes.
+    """
+    coding = (coding or "identity").strip().lower()
+    if coding == "identity":
+        if max_size is not None and len(data) > max_size:
+            raise DecodeError("document over %i bytes" % max_size)
+        yield data
+        return
+    if coding in ["gzip", "x-gzip"]:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif coding == "deflate":
+        # some servers send raw deflate, rather than the zlib format
+        if len(data) > 1 and ord(data[0:1]) & 0x0f == 8 and \
+        (ord(data[0:1]) * 256 + ord(data[1:2])) % 31 == 0:
+            decompressor = zlib.decompressobj()
         else:
-            self.path = path
-        
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    else:
+        raise DecodeError("unsupported content-coding %s" % coding)
+    size = 0
+    try:
+        while data:
+            chunk = decompressor.decompress(data, chunk_size)
+            data = decompressor.unconsumed_tail
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                raise DecodeError("document over %i bytes" % max_size)
+            yield chunk
+        yield decompressor.flush()
+    except zlib.error as why:
+        raise DecodeError(why)
+    if not getattr(decompressor, 'eof', True):  # Python 3.3+
+        raise DecodeError("truncated %s data" % coding)
+
+RFC3339 = r"^(\d{4})-(\d\d)-(\d\d)[Tt ](\d\d):(\d\d):(\d\d)(?:\.\d+)?" \
+          r"(?:[Zz]|([+-])(\d\d):?(\d\d))$"
+rfc3339_matcher = re.compile(RFC3339)
+def parse_date(instr):
+    m = rfc3339_matcher.match(instr)
+    if m is None:
+        return calendar.timegm(
+            parser.parse(instr).utctimetuple()
+        )   #IGNORE:E1103
+    year, month, day, hour, minute, sec, sign, tzh, tzm = m.groups()
+    updated = calendar.timegm(
+        (int(year), int(month), int(day), int(hour), int(minute), int(sec))
+    )
+    if sign:
+        offset = int(tzh) * 3600 + int(tzm) * 60
+        if sign == "-":
+            offset = -offset
+        updated = updated - offset
+    return updated
+
+
+## Host lookups for direct (proxy-less) fetches
+
+class HostCache:
+    """
+    Looks up the addresses of hosts to fetch from, and keeps them for as
+    long as their DNS records say (but no more than dns_ttl seconds);
+    failed lookups are kept for dns_negative_ttl seconds. Lookups of a
+    host that's already being looked up wait for that one to finish.
+
+    lookup() calls callback(address), or errback(message) if the host
+    can't be found.
+
+    Subclasses implement _resolve() for their I/O engine; it calls
+    callback(addresses, ttl) or errback(message).
+    """
+    def __init__(self, config):
+        self.max_ttl = config.getint("main", "dns_ttl")
+        self.negative_ttl = config.getint("main", "dns_negative_ttl")
+        self.cache = {}  # host: (expires, addresses or None, message)
+        self.waiting = {}  # host: [(callback, errback), ...]
+
+    def lookup(self, host, callback, errback):
+        if _is_address(host):
+            callback(host)
+            return
+        entry = self.cache.get(host, None)
+        if entry is not None:
+            if entry[0] > time.time():
+                self._answer(entry, callback, errback)
+                return
+            del self.cache[host]
+        if host in self.waiting:
+            self.waiting[host].append((callback, errback))
+            return
+        self.waiting[host] = [(callback, errback)]
+        def resolved(addresses, ttl):
+            self._resolved(host, min(ttl, self.max_ttl), addresses, None)
+        def failed(msg):
+            logging.info("dns_error <%s> (%s)", host, msg)
+            self._resolved(host, self.negative_ttl, None, msg)
+        self._resolve(host, resolved, failed)
+
+    def _resolved(self, host, ttl, addresses, msg):
+        entry = (time.time() + ttl, addresses, msg)
+        if ttl > 0:
+            self.cache[host] = entry
+        for callback, errback in self.waiting.pop(host, []):
+            self._answer(entry, callback, errback)
+
+    @staticmethod
+    def _answer(entry, callback, errback):
+        expires, addresses, msg = entry
+        if addresses:
+            callback(random.choice(addresses))
+        else:
+            errback(msg)
+
+    def _resolve(self, host, callback, errback):
+        raise NotImplementedError
+
+def _is_address(host):
+    for family in [socket.AF_INET, socket.AF_INET6]:
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+class Resolver(HostCache):
+    """
+    Looks up hosts in /etc/hosts, and then with Twisted's DNS client.
+    """
+    query_timeout = (1, 3, 11)
+
+    def __init__(self, reactor_, config):
+        HostCache.__init__(self, config)
+        self.resolver = ResolverChain([
+            names_hosts.Resolver(),
+            names_client.Resolver(resolv="/etc/resolv.conf", reactor=reactor_)
+        ])
+
+    def _resolve(self, host, callback, errback):
+        def got_records(result):
+            answers = result[0]
+            addresses = [
+                r.payload.dottedQuad() for r in answers if r.type == dns.A
+            ]
+            if not addresses:
+                errback("no addresses")
+                return
+            callback(addresses, min([r.ttl for r in answers]))
+        def failed(reason):
+            errback(reason.type.__name__)
+        d = self.resolver.lookupAddress(host, timeout=self.query_timeout)
+        d.addCallbacks(got_records, failed)
+
+class _ResolvingEndpointFactory:
+    """
+    Gives the Agent endpoints that connect to origin servers at addresses
+    from a HostCache.
+    """
+    def __init__(self, reactor_, hosts, timeout):
+        self.reactor = reactor_
+        self.hosts = hosts
+        self.timeout = timeout
+        self.tls_policy = None
+
+    def endpointForURI(self, uri):
+        endpoint = _ResolvingEndpoint(
+            self.reactor, self.hosts, _native(uri.host), uri.port,
+            self.timeout
+        )
+        if uri.scheme == b'https':
+            if self.tls_policy is None:
+                self.tls_policy = client.BrowserLikePolicyForHTTPS()
+            endpoint = wrapClientTLS(
+                self.tls_policy.creatorForNetloc(uri.host, uri.port), endpoint
+            )
+        return endpoint
+
+class _ResolvingEndpoint:
+    def __init__(self, reactor_, hosts, host, port, timeout):
+        self.reactor = reactor_
+        self.hosts = hosts
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def connect(self, factory):
+        connecting = []
+        def cancel(d):
+            for attempt in connecting:
+                attempt.cancel()
+        d = defer.Deferred(cancel)
+        def found(address):
+            if d.called:
+                return # cancelled
+            endpoint = TCP4ClientEndpoint(
+                self.reactor, address, self.port, timeout=self.timeout
+            )
+            attempt = endpoint.connect(factory)
+            connecting.append(attempt)
+            attempt.chainDeferred(d)
+        def not_found(msg):
+            if not d.called:
+                d.errback(internet_error.DNSLookupError(self.host, msg))
+        self.hosts.lookup(self.host, found, not_found)
+        return d
+
+
+## HTTP fetching over persistent connections
+
+class FetchQueue:
+    """
+    Runs no more than max_fetches requests at once, and no more than
+    max_host_connections to any one origin server (even through a proxy);
+    others wait, by group (i.e., channel), with urgent groups going first.
+
+    fetch() calls callback(page, response_headers) when a 200 response
+    has been read, where response_headers maps lowercased names to lists
+    of values; otherwise, errback(status, message) is called, with the
+    HTTP status (or None if there wasn't one) and a message for the log.
+
+    Subclasses implement _request() for their I/O engine.
+    """
+    def __init__(self, config):
+        self.timeout = config.getint("main", "fetch_timeout")
+        self.max_fetches = config.getint("main", "max_fetches")
+        self.max_host_fetches = config.getint("main", "max_host_connections")
+        self.active = 0
+        self.host_active = {}  # origin host[:port]: requests running
+        self.waiting = {}  # group: [(url, headers, callback, errback), ...]
+        self.normal = deque()  # groups waiting
+        self.urgent = deque()  # groups waiting that have been promoted
+        self.starting = False  # whether _next() is starting requests
+
+    def fetch(self, url, headers, callback, errback, group=None, 
+              urgent=False):
+        if self.active < self.max_fetches and self._host_room(url):
+            self._start(url, headers, callback, errback)
+            return
+        if group not in self.waiting:
+            self.waiting[group] = []
+            self.normal.append(group)
+        self.waiting[group].append((url, headers, callback, errback))
+        if urgent:
+            self.promote(group)
+
+    def promote(self, group):
+        if group in self.waiting and group not in self.urgent:
+            self.urgent.append(group)
+
+    def cancel(self, group, urls=None):
+        """
+        Drop group's waiting requests (only those for urls, if given);
+        their callbacks are never called. Running requests carry on.
+        """
+        requests = self.waiting.get(group, None)
+        if not requests:
+            return
+        if urls is not None:
+            requests[:] = [r for r in requests if r[0] not in urls]
+        if urls is None or not requests:
+            del self.waiting[group]  # _pop() drops it from the queues
+
+    def _next(self):
+        if self.starting:
+            return  # requests that fail straight away come back here
+        self.starting = True
+        try:
+            while self.active < self.max_fetches:
+                request = self._pop()
+                if request is None:
+                    break
+                self._start(*request)
+        finally:
+            self.starting = False
+
+    def _pop(self):
+        """
+        Take the first waiting request whose origin server has room.
+        """
+        for queue in [self.urgent, self.normal]:
+            for group in list(queue):
+                requests = self.waiting.get(group, None)
+                if not requests:
+                    queue.remove(group)
+                    continue
+                for i, request in enumerate(requests):
+                    if self._host_room(request[0]):
+                        del requests[i]
+                        if not requests:
+                            del self.waiting[group]
+                            queue.remove(group)
+                        return request
+        return None
+
+    def _host_room(self, url):
+        return not self.max_host_fetches or \
+            self.host_active.get(_fetch_host(url), 0) < self.max_host_fetches
+
+    def _start(self, url, headers, callback, errback):
+        host = _fetch_host(url)
+        self.active += 1
+        self.host_active[host] = self.host_active.get(host, 0) + 1
+        def finished():
+            self.active -= 1
+            self.host_active[host] -= 1
+            if not self.host_active[host]:
+                del self.host_active[host]
+            if self.active < self.max_fetches:
+                self._next()
+        def done(page, res_headers):
+            finished()
+            callback(page, res_headers)
+        def failed(status, msg):
+            finished()
+            errback(status, msg)
+        try:
+            self._request(url, headers or {}, done, failed)
+        except Exception as why:  # don't lose the slot
+            failed(None, '"Unknown error (%s: %s)"' % (
+                why.__class__.__name__, why
+            ))
+
+    def _request(self, url, headers, callback, errback):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+def _fetch_host(url):
+    try:
+        return urlsplit(url).netloc.lower()
+    except ValueError:
+        return ""
+
+class Fetcher(FetchQueue):
+    """
+    Fetches documents with Twisted, over a shared pool of persistent 
+    HTTP/1.1 connections, keyed by the proxy (if configured) or the origin
+    server, following redirects. Origin servers' addresses come from a
+    shared Resolver.
+    """
+    def __init__(self, reactor_, config):
+        FetchQueue.__init__(self, config)
+        self.reactor = reactor_
+        self.pool = client.HTTPConnectionPool(reactor_, persistent=True)
+        self.pool.maxPersistentPerHost = config.getint(
+            "main", "max_host_connections"
+        )
+        self.pool.cachedConnectionTimeout = config.getint(
+            "main", "idle_timeout"
+        )
+        proxy = config.get("main", "http_proxy")
+        if proxy:
+            host, port = proxy.split(':')
+            endpoint = TCP4ClientEndpoint(
+                reactor_, host, int(port), timeout=self.timeout
+            )
+            agent = client.ProxyAgent(endpoint, reactor_, self.pool)
+        else:
+            agent = client.Agent.usingEndpointFactory(
+                reactor_, 
+                _ResolvingEndpointFactory(
+                    reactor_, Resolver(reactor_, config), self.timeout
+                ),
+                pool=self.pool
+            )
+        self.agent = client.RedirectAgent(agent)
+
+    def _request(self, url, headers, callback, errback):
+        req_headers = Headers()
+        for name, value in headers.items():
+            req_headers.setRawHeaders(_encode(name), [_encode(value)])
+        try:
+            d = self.agent.request(b'GET', _encode(url), req_headers)
+        except ValueError:  # URIs with spaces, non-ASCII, etc.
+            errback(None, '"Invalid URI"')
+            return
+        timed_out = []
+        def timeout():
+            timed_out.append(True)
+            d.cancel()
+        timer = self.reactor.callLater(self.timeout, timeout)
+        def got_response(response):
+            reader = _BodyReader(response)
+            response.deliverBody(reader)
+            return reader.deferred
+        def got_body(result):
+            if timer.active():
+                timer.cancel()
+            code, phrase, page, res_headers = result
+            if code != 200:
+                errback(code, '"%s %s"' % (code, _native(phrase)))
+            else:
+                callback(page, res_headers)
+        def failed(reason):
+            if timer.active():
+                timer.cancel()
+            elif timed_out:
+                errback(None, '"Timeout"')
+                return
+            if reason.check(internet_error.DNSLookupError):
+                msg = '"DNS lookup error"'
+            elif reason.check(internet_error.TimeoutError):
+                msg = '"Timeout"'
+            elif reason.check(internet_error.ConnectionRefusedError):
+                msg = '"Connection refused"'
+            elif reason.check(internet_error.ConnectError):
+                msg = '"Connection error"'
+            elif reason.check(client.ResponseFailed):
+                msg = '"Response failed"'
+            else:
+                msg = '"Unknown error (%s)"' % reason.type
+            errback(None, msg)
+        d.addCallback(got_response)
+        d.addCallbacks(got_body, failed)
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+class _BodyReader(protocol.Protocol):
+    def __init__(self, response):
+        self.response = response
+        self.data = []
+        self.deferred = defer.Deferred(self._cancel)
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        if self.deferred.called:
+            return # cancelled
+        if not reason.check(client.ResponseDone, PotentialDataLoss):
+            self.deferred.errback(reason)
+            return
+        res_headers = dict([
+            (_native(name).lower(), [_native(v) for v in values]) 
+            for name, values in self.response.headers.getAllRawHeaders()
+        ])
+        self.deferred.callback((
+            self.response.code, self.response.phrase, b"".join(self.data),
+            res_headers
+        ))
+
+    def _cancel(self, d):
+        self.transport.stopProducing()
+
 if __name__ == '__main__':
+    sys.modules.setdefault('manager', sys.modules[__name__]) # for aio_engine
+    args = sys.argv[1:]
+    poller = "--poller" in args
+    if poller:
+        args.remove("--poller")
     try:
-        conf = sys.argv[1]
+        conf = args[0]
     except IndexError:
-        sys.stderr.write("USAGE: %s config_filename\n" % sys.argv[0]) 
+        sys.stderr.write("USAGE: %s [--poller] config_filename\n" % \
+            sys.argv[0]
+        ) 
         sys.exit(1)
     if not os.path.exists(conf):
         error("Can't find config file %s." % conf)
-    main(conf)
+    main(conf, poller)
@@ -0,0 +1,502 @@
+#!/usr/bin/env python
+
+"""
+Cache Channel Publisher
+
+Publishes stale events as an RFC5005 archived Atom channel, made of static
+files in channel_dir:
+
+ - current.atom, the newest events; rewritten (from a journal of
+   pre-rendered entries) each time events are added.
+ - archive/<n>.atom, pages of page_size events each. Once written, an
+   archive page doesn't change (until it's older than the channel's
+   lifetime), so it can be cached for a long time.
+
+Each is also written gzipped (with a .gz suffix), so that servers can send
+compressed responses without compressing them on every request.
+
+Any Web server can serve channel_dir; current.atom is the channel's URI
+(channel_uri). --serve runs a small server that sends strong ETags, answers
+conditional requests and sends the gzipped files to clients that accept
+them.
+
+Usage: publish.py [options] config_filename; see --help. Events can be
+given with --stale and --prefix, or in bulk with --stale-file (one URI per
+line, or "prefix <URI>" for a prefix event; "-" reads stdin). --gc makes
+archive pages older than the channel's lifetime empty, and removes them
+later. If push_to is configured, new events are also pushed to channel
+managers (see push_address in sample.conf).
+
+It requires Python 2.7+ (or 3), and runs on Unix.
+
+See sample_publish.conf for details of the configuration file.
+"""
+
+from __future__ import print_function
+
+__copyright__ = """\
+Copyright (c) 2010 Yahoo! Inc.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import re
+import sys
+import time
+import gzip
+import fcntl
+import hashlib
+import optparse
+import threading
+from io import BytesIO
+from xml.sax.saxutils import escape, quoteattr
+try:
+    from ConfigParser import SafeConfigParser as ConfigParser
+    import ConfigParser as configparser
+except ImportError:
+    from configparser import ConfigParser
+    import configparser
+try:
+    from urllib import quote
+    from urllib2 import urlopen, Request, URLError
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from urllib.parse import quote
+    from urllib.request import urlopen, Request
+    from urllib.error import URLError
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+
+FEED_HEAD = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"
+      xmlns:cc="http://purl.org/syndication/cache-channel"
+      xmlns:fh="http://purl.org/syndication/history/1.0">
+ <title>%(title)s</title>
+ <id>%(id)s</id>
+ <updated>%(updated)s</updated>
+ <author><name>%(author)s</name></author>
+ <cc:precision>%(precision)i</cc:precision>
+ <cc:lifetime>%(lifetime)i</cc:lifetime>
+ <cc:archive_num>%(archive_num)i</cc:archive_num>
+%(head)s"""
+FEED_TAIL = b"</feed>\n"
+ENTRY = (
+    '<entry><title>stale</title><link href=%(uri)s/><id>%(id)s</id>'
+    '<updated>%(updated)s</updated><cc:stale%(scope)s/></entry>'
+)
+ARCHIVE_FILE = re.compile(r"^(\d+)\.atom$")
+
+def rfc3339(when):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(when))
+
+def gzipped(data):
+    buf = BytesIO()
+    gz = gzip.GzipFile(fileobj=buf, mode="wb", mtime=0)
+    gz.write(data)
+    gz.close()
+    return buf.getvalue()
+
+
+class Publisher:
+    """
+    Adds events to the channel in channel_dir, and keeps its pages.
+
+    New events are rendered once, and appended to a journal that holds the
+    current page's entries (oldest first); the current page is assembled
+    from it. When the journal has page_size entries, they're frozen into
+    the next archive page.
+    """
+    def __init__(self, config):
+        self.dir = config.get("main", "channel_dir")
+        self.archive_dir = os.path.join(self.dir, "archive")
+        self.journal = os.path.join(self.dir, "journal")
+        self.channel_uri = config.get("main", "channel_uri")
+        self.page_size = config.getint("main", "page_size")
+        self.lifetime = config.getint("main", "lifetime")
+        self.push_to = (config.get("main", "push_to") or "").split()
+        self.push_timeout = config.getint("main", "push_timeout")
+        self.feed = {
+            'title': escape(config.get("main", "channel_title")),
+            'author': escape(config.get("main", "channel_author")),
+            'id': escape(
+                config.get("main", "channel_id") or self.channel_uri
+            ),
+            'precision': config.getint("main", "precision"),
+            'lifetime': self.lifetime,
+        }
+        for d in [self.dir, self.archive_dir]:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+    def add_events(self, uris, prefixes=()):
+        """
+        Add stale events for uris (and prefix events for prefixes) in one
+        batch, and push them if push_to is configured.
+        """
+        now = time.time()
+        entries = [self.render_entry(uri, now) for uri in uris] + \
+            [self.render_entry(uri, now, True) for uri in prefixes]
+        if not entries and \
+        os.path.exists(os.path.join(self.dir, "current.atom")):
+            return
+        lock = self.lock()
+        try:
+            journal = self.read_journal()
+            if len(journal) + len(entries) < self.page_size:
+                fh = open(self.journal, 'ab')
+                try:
+                    fh.write(b"".join([e + b"\n" for e in entries]))
+                finally:
+                    fh.close()
+                journal.extend(entries)
+            else:
+                journal.extend(entries)
+                archive_num = self.next_archive_num()
+                while len(journal) >= self.page_size:
+                    self.write_archive(
+                        archive_num, journal[:self.page_size], now
+                    )
+                    journal = journal[self.page_size:]
+                    archive_num += 1
+                self._write(self.journal, b"".join(
+                    [e + b"\n" for e in journal]
+                ), False)
+            self.write_current(journal, now)
+        finally:
+            lock.close()
+        self.push(entries)
+
+    def render_entry(self, uri, when, prefix=False):
+        return (ENTRY % {
+            'uri': quoteattr(uri),
+            'id': escape("%s#%.6f" % (uri, when)),
+            'updated': rfc3339(when),
+            'scope': prefix and ' scope="prefix"' or '',
+        }).encode("utf-8")
+
+    def read_journal(self):
+        try:
+            fh = open(self.journal, 'rb')
+        except IOError:
+            return []
+        try:
+            return [line.rstrip(b"\n") for line in fh if line.strip()]
+        finally:
+            fh.close()
+
+    def archive_nums(self):
+        nums = []
+        for name in os.listdir(self.archive_dir):
+            m = ARCHIVE_FILE.match(name)
+            if m:
+                nums.append(int(m.group(1)))
+        nums.sort()
+        return nums
+
+    def next_archive_num(self):
+        nums = self.archive_nums()
+        return nums and nums[-1] + 1 or 0
+
+    def archive_file(self, archive_num):
+        return os.path.join(self.archive_dir, "%i.atom" % archive_num)
+
+    def write_archive(self, archive_num, entries, now):
+        head = [' <link rel="self" href="%i.atom"/>\n' % archive_num,
+                ' <fh:archive/>\n']
+        if os.path.exists(self.archive_file(archive_num - 1)):
+            head.append(' <link rel="prev-archive" href="%i.atom"/>\n' %
+                (archive_num - 1)
+            )
+        self._write(self.archive_file(archive_num), self.render(
+            archive_num, head, entries, now
+        ))
+
+    def write_current(self, entries, now):
+        archive_num = self.next_archive_num()
+        head = [' <link rel="self" href="current.atom"/>\n']
+        if archive_num > 0:
+            head.append(
+                ' <link rel="prev-archive" href="archive/%i.atom"/>\n' %
+                (archive_num - 1)
+            )
+        self._write(os.path.join(self.dir, "current.atom"), self.render(
+            archive_num, head, entries, now
+        ))
+
+    def render(self, archive_num, head, entries, now):
+        feed = dict(self.feed)
+        feed.update({
+            'updated': rfc3339(now),
+            'archive_num': archive_num,
+            'head': "".join(head),
+        })
+        return b"".join([(FEED_HEAD % feed).encode("utf-8")] +
+            [b" " + e + b"\n" for e in reversed(entries)] + [FEED_TAIL]
+        )
+
+    def gc(self):
+        """
+        Empty archive pages whose events are older than the channel's
+        lifetime (keeping their URIs, but dropping their prev-archive
+        links), and remove empty pages once the next page has also been
+        empty for a lifetime, so that no page links to a missing one.
+        """
+        now = time.time()
+        lock = self.lock()
+        try:
+            nums = self.archive_nums()
+            emptied = {}  # archive_num: when it was emptied
+            for num in nums:
+                path = self.archive_file(num)
+                mtime = os.path.getmtime(path)
+                fh = open(path, 'rb')
+                try:
+                    empty = b"<entry>" not in fh.read()
+                finally:
+                    fh.close()
+                if empty:
+                    emptied[num] = mtime
+                elif mtime < now - self.lifetime:
+                    head = [' <link rel="self" href="%i.atom"/>\n' % num,
+                            ' <fh:archive/>\n']
+                    self._write(path, self.render(num, head, [], now))
+                    emptied[num] = now
+            for num in nums:
+                if num in emptied and \
+                emptied.get(num + 1, now) < now - self.lifetime:
+                    for path in [self.archive_file(num),
+                                 self.archive_file(num) + ".gz"]:
+                        os.remove(path)
+        finally:
+            lock.close()
+
+    def push(self, entries):
+        if not self.push_to or not entries:
+            return
+        body = self.render(0, [], entries, time.time())
+        for manager in self.push_to:
+            url = "%s/events?channel=%s" % (
+                manager.rstrip("/"), quote(self.channel_uri, safe="")
+            )
+            try:
+                urlopen(Request(url, body, {
+                    'Content-Type': "application/atom+xml"
+                }), timeout=self.push_timeout).read()
+            except (URLError, IOError) as why:
+                sys.stderr.write("Can't push to %s (%s)\n" % (manager, why))
+
+    def lock(self):
+        fh = open(os.path.join(self.dir, ".lock"), 'a')
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        return fh
+
+    def _write(self, path, data, compress=True):
+        for path, data in [(path, data)] + \
+        (compress and [(path + ".gz", gzipped(data))] or []):
+            tmpfile = "%s.tmp" % path
+            fh = open(tmpfile, 'wb')
+            try:
+                fh.write(data)
+                fh.flush()
+                os.fsync(fh.fileno())
+            finally:
+                fh.close()
+            os.rename(tmpfile, path)
+
+
+## serving
+
+class ChannelFiles:
+    """
+    Reads files from channel_dir, keeping them (and their ETags) in memory
+    until they change.
+    """
+    def __init__(self, channel_dir):
+        self.dir = channel_dir
+        self.cache = {}  # path: (stat, body, etag)
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Return (body, etag) for path, or None if it doesn't exist.
+        """
+        full = os.path.join(self.dir, path)
+        try:
+            st = os.stat(full)
+        except OSError:
+            return None
+        stamp = (st.st_ino, st.st_mtime, st.st_size)
+        with self.lock:
+            cached = self.cache.get(path, None)
+        if cached is not None and cached[0] == stamp:
+            return cached[1:]
+        try:
+            fh = open(full, 'rb')
+            try:
+                body = fh.read()
+            finally:
+                fh.close()
+        except IOError:
+            return None
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()[:20]
+        with self.lock:
+            self.cache[path] = (stamp, body, etag)
+        return body, etag
+
+class ChannelHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "publish.py"
+    archive_path = re.compile(r"^/archive/\d+\.atom$")
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def respond(self, send_body):
+        path = self.path.split("?", 1)[0]
+        if path == "/current.atom":
+            max_age = self.server.current_max_age
+        elif self.archive_path.match(path):
+            max_age = self.server.lifetime
+        else:
+            return self.send(404, b"", {}, send_body)
+        headers = {
+            "Content-Type": "application/atom+xml",
+            "Cache-Control": "max-age=%i" % max_age,
+            "Vary": "Accept-Encoding",
+        }
+        found = None
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            found = self.server.files.get(path[1:] + ".gz")
+            if found is not None:
+                headers["Content-Encoding"] = "gzip"
+        if found is None:
+            found = self.server.files.get(path[1:])
+        if found is None:
+            return self.send(404, b"", {}, send_body)
+        body, etag = found
+        headers["ETag"] = etag
+        if etag in [t.strip() for t in
+                    self.headers.get("If-None-Match", "").split(",")]:
+            return self.send(304, b"", headers, send_body)
+        self.send(200, body, headers, send_body)
+
+    def send(self, status, body, headers, send_body):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body and status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class ChannelServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve(config):
+    host, port = config.get("main", "serve_address").rsplit(":", 1)
+    server = ChannelServer((host, int(port)), ChannelHandler)
+    server.files = ChannelFiles(config.get("main", "channel_dir"))
+    server.lifetime = config.getint("main", "lifetime")
+    server.current_max_age = config.getint("main", "current_max_age")
+    server.serve_forever()
+
+
+def read_events(fh):
+    uris, prefixes = [], []
+    for line in fh:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("prefix "):
+            prefixes.append(line.split(None, 1)[1])
+        else:
+            uris.append(line)
+    return uris, prefixes
+
+def main():
+    parser = optparse.OptionParser(
+        usage="%prog [options] config_filename"
+    )
+    parser.add_option("--stale", action="append", default=[],
+        help="mark URI stale", metavar="URI")
+    parser.add_option("--prefix", action="append", default=[],
+        help="mark everything under URI stale", metavar="URI")
+    parser.add_option("--stale-file", metavar="FILE",
+        help="read events from FILE (- for stdin)")
+    parser.add_option("--gc", action="store_true",
+        help="empty or remove archive pages older than the lifetime")
+    parser.add_option("--serve", action="store_true",
+        help="serve channel_dir on serve_address")
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("need a configuration file")
+    config = ConfigParser({
+        'channel_id': None,
+        'channel_title': "channel",
+        'channel_author': "",
+        'precision': "60",
+        'lifetime': "604800",
+        'page_size': "500",
+        'current_max_age': "15",
+        'push_to': None,
+        'push_timeout': "5",
+        'serve_address': "127.0.0.1:8080",
+    }, allow_no_value=True)
+    try:
+        if not config.read(args[0]):
+            parser.error("can't read %s" % args[0])
+        if opts.serve:
+            serve(config)
+            return
+        publisher = Publisher(config)
+        uris, prefixes = list(opts.stale), list(opts.prefix)
+        if opts.stale_file == "-":
+            more = read_events(sys.stdin)
+        elif opts.stale_file:
+            fh = open(opts.stale_file)
+            try:
+                more = read_events(fh)
+            finally:
+                fh.close()
+        else:
+            more = ([], [])
+        uris.extend(more[0])
+        prefixes.extend(more[1])
+        publisher.add_events(uris, prefixes)  # writes current.atom if new
+        if opts.gc:
+            publisher.gc()
+    except configparser.Error as why:
+        sys.stderr.write("FATAL: Configuration file: %s\n" % why)
+        sys.exit(1)
+    except (IOError, OSError) as why:
+        sys.stderr.write("FATAL: %s\n" % why)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()